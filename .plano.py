@@ -59,6 +59,74 @@ def find_wheel():
     else:
         fail("Wheel file not found")
 
+@command
+def benchmark(count=100000):
+    """
+    Compare queue dispatch with and without unsettled-delivery tracking
+    """
+
+    check_program("qbroker")
+
+    port = get_random_port()
+    url = f"//localhost:{port}/benchmark"
+    broker = start(f"qbroker --quiet --port {port}")
+
+    try:
+        await_port(port)
+
+        with temp_file() as messages:
+            write(messages, "message\n" * count)
+
+            for mode, options in (("Fire-and-forget", "--presettled"), ("Tracked", "")):
+                run(f"qsend {url} --presettled --input {messages} --quiet")
+
+                start_time = get_time()
+                run(f"qreceive {url} --count {count} {options} --output /dev/null --quiet")
+                duration = get_time() - start_time
+
+                print(f"{mode}: {count} messages in {duration:.2f} s ({count / duration:,.0f} messages/s)")
+    finally:
+        stop(broker)
+
+@command
+def benchmark_workers(count=20000, addresses=4, workers=4):
+    """
+    Compare throughput with one broker process and with several workers
+    """
+
+    check_program("qbroker")
+
+    with temp_file() as messages:
+        write(messages, "message\n" * count)
+
+        for worker_count in (1, workers):
+            port = get_random_port()
+            broker = start(f"qbroker --quiet --port {port} --workers {worker_count}")
+
+            try:
+                await_port(port)
+
+                # One producer and one consumer per address, all at once
+                start_time = get_time()
+                procs = list()
+
+                for i in range(addresses):
+                    url = f"//localhost:{port}/benchmark-{i}"
+
+                    procs.append(start(f"qreceive {url} --count {count} --output /dev/null --quiet"))
+                    procs.append(start(f"qsend {url} --input {messages} --quiet"))
+
+                for proc in procs:
+                    wait(proc)
+
+                duration = get_time() - start_time
+                total = count * addresses
+
+                print(f"{worker_count} worker(s): {total} messages on {addresses} addresses in {duration:.2f} s "
+                      f"({total / duration:,.0f} messages/s)")
+            finally:
+                stop(broker)
+
 @command
 def clean():
     remove("dist")
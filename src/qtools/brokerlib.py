@@ -17,23 +17,37 @@
 # under the License.
 #
 
+import array as _array
+import bisect as _bisect
 import collections as _collections
+import heapq as _heapq
+import json as _json
+import mmap as _mmap
 import os as _os
 import proton as _proton
 import proton.handlers as _handlers
 import proton.reactor as _reactor
+import re as _re
 import uuid as _uuid
 import shutil as _shutil
+import signal as _signal
+import socket as _socket
+import struct as _struct
 import subprocess as _subprocess
 import sys as _sys
 import time as _time
 import tempfile as _tempfile
+import zlib as _zlib
 
 class Broker:
     def __init__(self, host, port, id=None, ready_file=None,
                  user=None, password=None,
                  cert=None, key=None, trust=None,
-                 topics=None,
+                 topics=None, retention=None, priority_queues=None, last_value_queues=None,
+                 partitioned_queues=None, watermarks=None, passthrough=False,
+                 dead_letters=None, max_deliveries=None,
+                 journal_dir=None, fsync="tick", checkpoint_interval=60, idle_timeout=60,
+                 workers=1, spill_after=None, spill_dir=None,
                  quiet=False, verbose=False, debug_enabled=False,
                  init_only=False):
         self.host = host
@@ -45,6 +59,22 @@ class Broker:
         self.cert = cert
         self.key = key
         self.trust = trust
+        self.topics = topics
+        self.retention = retention
+        self.priority_queues = priority_queues
+        self.last_value_queues = last_value_queues
+        self.partitioned_queues = partitioned_queues
+        self.watermarks = watermarks
+        self.passthrough = passthrough
+        self.dead_letters = dead_letters
+        self.max_deliveries = max_deliveries
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.checkpoint_interval = checkpoint_interval
+        self.idle_timeout = idle_timeout
+        self.workers = workers
+        self.spill_after = spill_after
+        self.spill_dir = spill_dir
         self.quiet = quiet
         self.verbose = verbose
         self.debug_enabled = debug_enabled
@@ -53,19 +83,181 @@ class Broker:
         if self.id is None:
             self.id = "broker-{0}".format(_uuid.uuid4().hex[:8])
 
-        self.container = _reactor.Container(_Handler(self))
+        # The credit each producer link is kept topped up to
+        self.credit_window = 100
+
+        if self.workers > 1:
+            self.container = _reactor.Container(_FrontDoor(self))
+        else:
+            self.container = _reactor.Container(_Handler(self))
+
         self.container.container_id = self.id # XXX Obnoxious
 
         if self.debug_enabled:
             self.verbose = True
 
         self._config_dir = None
+        self._worker_dir = None
+        self._worker_procs = list()
+        self._worker_host = None
+        self._worker_ports = list()
+        self._worker_urls = list()
+        self._worker_placements = dict()
+        self._spill_dir = None
+        self._spill_dir_is_temp = False
         self._nodes = dict()
+        self._subscriptions = _AddressTrie()
+        self._routes = dict()
+        self._producers = _collections.defaultdict(set)
+
+        # The consumer and producer links of each connection, so closing
+        # one costs only the links it owns
+        self._connection_links = _collections.defaultdict(set)
+
+        # Queue messages sent to each consumer link and not yet settled,
+        # by delivery.  Released and modified messages, and those left
+        # unsettled when the link closes, go back to their queue.
+        self._unsettled = dict()
+
+        self._timers = list()
+        self._journal = None
+        self._expiry_wheel = _ExpiryWheel(self)
+        self._delay_store = _DelayStore(self)
+
+        # Nodes with messages or credit changes not yet dispatched.
+        # They are forwarded once per reactor iteration, so a burst of
+        # deliveries costs one pass over each node's consumers.
+        self._dirty_nodes = set()
+
+        # Event counts, such as messages dropped because their TTL passed
+        self.metrics = _collections.Counter()
+
+        # In multi-process mode the workers own the nodes
+        if self.workers == 1:
+            self._init_nodes()
+
+    def _init_nodes(self):
+        self._timers.append(_Timer(self._expiry_wheel.resolution, self._expiry_wheel.advance))
+        self._timers.append(_Timer(self._delay_store.resolution, self._delay_store.advance))
+
+        if self.idle_timeout > 0:
+            self._timers.append(_Timer(self.idle_timeout, self._evict_idle_nodes))
+
+        if self.spill_after is not None:
+            if self.spill_dir is None:
+                self._spill_dir = _tempfile.mkdtemp(prefix="brokerlib-")
+                self._spill_dir_is_temp = True
+            else:
+                self._spill_dir = self.spill_dir
 
-        if topics:
-            for address in topics:
+                # Spilled messages do not outlive the broker
+                _os.makedirs(self._spill_dir, exist_ok=True)
+
+                for name in _os.listdir(self._spill_dir):
+                    if name.endswith(".page"):
+                        _os.remove(_os.path.join(self._spill_dir, name))
+
+        if self.topics:
+            for address in self.topics:
                 self._create_topic(address)
 
+        if self.retention:
+            for address, policy in self.retention:
+                node = self._nodes.get(address)
+
+                if not isinstance(node, _Topic):
+                    self.fail("Retention policy for '{0}' requires a topic", address)
+
+                try:
+                    node.retention = _Retention(policy)
+                except ValueError as e:
+                    self.fail("Invalid retention policy '{0}': {1}", policy, e)
+
+            self._timers.append(_Timer(1, self._trim_topics))
+
+        if self.priority_queues:
+            for address in self.priority_queues:
+                node = self._nodes.get(address)
+
+                if node is None:
+                    node = self._create_queue(address)
+                elif not isinstance(node, _Queue):
+                    self.fail("Priority for '{0}' requires a queue", address)
+
+                node.messages = _PriorityDeque()
+
+        if self.last_value_queues:
+            for address, key in self.last_value_queues:
+                node = self._nodes.get(address)
+
+                if node is None:
+                    node = self._create_queue(address)
+                elif not isinstance(node, _Queue):
+                    self.fail("A last-value key for '{0}' requires a queue", address)
+                elif isinstance(node.messages, _PriorityDeque):
+                    self.fail("Queue '{0}' cannot be both a priority queue and a last-value queue", address)
+
+                node.messages = _LastValueDeque(node, key)
+
+        if self.partitioned_queues:
+            for address, key, count in self.partitioned_queues:
+                node = self._nodes.get(address)
+
+                if node is None:
+                    node = self._create_queue(address)
+                elif not isinstance(node, _Queue):
+                    self.fail("Partitions for '{0}' require a queue", address)
+                elif isinstance(node.messages, (_PriorityDeque, _LastValueDeque)):
+                    self.fail("Queue '{0}' cannot be partitioned and also ordered by priority or last value", address)
+
+                if count < 1:
+                    self.fail("The partition count for '{0}' must be at least 1", address)
+
+                node.messages = node.partitions = _Partitions(key, count)
+
+        if self.watermarks:
+            for address, high, low in self.watermarks:
+                node = self._nodes.get(address)
+
+                if node is None:
+                    node = self._create_queue(address)
+                elif not isinstance(node, _Queue):
+                    self.fail("Watermarks for '{0}' require a queue", address)
+
+                if low > high:
+                    self.fail("The low watermark for '{0}' is above the high watermark", address)
+
+                node.high_watermark = high
+                node.low_watermark = low
+
+        if self.dead_letters:
+            for address, dead_letter_address in self.dead_letters:
+                node = self._nodes.get(address)
+
+                if node is None:
+                    node = self._create_queue(address)
+                elif not isinstance(node, _Queue):
+                    self.fail("A dead-letter address for '{0}' requires a queue", address)
+
+                if dead_letter_address not in self._nodes:
+                    self._create_queue(dead_letter_address)
+
+                node.dead_letter_address = dead_letter_address
+
+        if self.journal_dir is not None:
+            if self.fsync not in ("always", "tick", "never"):
+                try:
+                    interval = int(self.fsync) / 1000
+                except ValueError:
+                    self.fail("Invalid fsync policy '{0}'", self.fsync)
+
+                self._timers.append(_Timer(interval, self._sync_journal))
+
+            self._journal = _Journal(self, self.journal_dir, self.fsync)
+
+            self._timers.append(_Timer(1, self._journal.compact))
+            self._timers.append(_Timer(self.checkpoint_interval, self._checkpoint))
+
     def init(self):
         self.info("Initializing {0}", self)
 
@@ -89,7 +281,7 @@ class Broker:
                 self.fail("Trust file {0} does not exist", self.trust)
 
     def _init_sasl_config(self):
-        self._config_dir = _tempfile.mkdtemp(prefix="brokerlib-", suffix="")
+        self._config_dir = _tempfile.mkdtemp(prefix="brokerlib-")
 
         config_file = _os.path.join(self._config_dir, "proton-server.conf")
         sasldb_file = _os.path.join(self._config_dir, "users.sasldb")
@@ -140,6 +332,12 @@ class Broker:
             if self.init_only:
                 return
 
+            if self._journal is not None:
+                self._recover()
+
+            if self.workers > 1:
+                self._start_workers()
+
             self.container.run()
         except OSError as e:
             if self.debug_enabled:
@@ -147,20 +345,220 @@ class Broker:
 
             self.fail(e)
         finally:
+            self._stop_workers()
+
+            if self._spill_dir_is_temp:
+                _shutil.rmtree(self._spill_dir, ignore_errors=True)
+
             if self._config_dir and _os.path.exists(self._config_dir):
                 _shutil.rmtree(self.dir, ignore_errors=True)
 
+    def _listen(self, container):
+        interface = "{0}:{1}".format(self.host, self.port)
+
+        if self.cert is not None:
+            interface = "amqps://{0}".format(interface)
+
+            ssl_domain = container.ssl.server
+            ssl_domain.set_credentials(self.cert, self.key, None)
+
+            if self.trust:
+                ssl_domain.set_peer_authentication(_proton.SSLDomain.VERIFY_PEER, self.trust)
+                ssl_domain.set_trusted_ca_db(self.trust)
+            else:
+                ssl_domain.set_peer_authentication(_proton.SSLDomain.ANONYMOUS_PEER)
+
+        acceptor = container.listen(interface)
+
+        self.notice("Listening for connections on '{0}'", interface)
+
+        return acceptor
+
+    def _write_ready_file(self):
+        if self.ready_file is not None:
+            with open(self.ready_file, "w") as f:
+                f.write("ready\n")
+
+    def _start_workers(self):
+        # Turn termination into an exit, so the workers are stopped too
+        _signal.signal(_signal.SIGTERM, lambda signum, frame: _sys.exit(0))
+
+        # Each worker moves messages only to addresses it owns, so a
+        # queue goes with its dead-letter address, and with every other
+        # queue that shares it
+        for address, dead_letter_address in self.dead_letters or ():
+            self._worker_placements[address] = dead_letter_address
+
+        # Follow chains, as when a dead-letter queue has a dead-letter
+        # address of its own
+        for address, target in list(self._worker_placements.items()):
+            seen = {address}
+
+            while target in self._worker_placements and target not in seen:
+                seen.add(target)
+                target = self._worker_placements[target]
+
+            self._worker_placements[address] = target
+
+        self._worker_dir = _tempfile.mkdtemp(prefix="brokerlib-")
+
+        # Clients may be redirected to the workers, so they listen on
+        # the same host as the front door.  With TLS they stay private,
+        # since they have no TLS configuration.
+        self._worker_host = self.host if self.cert is None else "127.0.0.1"
+
+        for index in range(self.workers):
+            port = _get_free_port()
+            ready_file = _os.path.join(self._worker_dir, "worker-{0}.ready".format(index))
+
+            with open(ready_file, "w"):
+                pass
+
+            command = self._worker_command(index, port, ready_file)
+
+            self._worker_procs.append(_subprocess.Popen(command))
+            self._worker_ports.append(port)
+            self._worker_urls.append("{0}:{1}".format(self._worker_host, port))
+
+        for index in range(self.workers):
+            await_broker(_os.path.join(self._worker_dir, "worker-{0}.ready".format(index)))
+
+        self.notice("Started {0} workers", self.workers)
+
+    def _worker_command(self, index, port, ready_file):
+        command = [_sys.executable, _os.path.abspath(__file__),
+                   "--host", self._worker_host, "--port", str(port),
+                   "--id", "{0}-{1}".format(self.id, index),
+                   "--ready-file", ready_file]
+
+        for address in self.topics or ():
+            command += ["--topic", address]
+
+        for address, policy in self.retention or ():
+            command += ["--retention", address, policy]
+
+        for address in self.priority_queues or ():
+            command += ["--priority-queue", address]
+
+        for address, key in self.last_value_queues or ():
+            command += ["--last-value-queue", address, key]
+
+        for address, key, count in self.partitioned_queues or ():
+            command += ["--partitioned-queue", address, key, str(count)]
+
+        for address, high, low in self.watermarks or ():
+            command += ["--watermarks", address, str(high), str(low)]
+
+        for address, dead_letter_address in self.dead_letters or ():
+            command += ["--dead-letter", address, dead_letter_address]
+
+        if self.max_deliveries is not None:
+            command += ["--max-deliveries", str(self.max_deliveries)]
+
+        if self.passthrough:
+            command.append("--passthrough")
+
+        if self.spill_after is not None:
+            command += ["--spill-after", str(self.spill_after)]
+
+            if self.spill_dir is not None:
+                command += ["--spill-dir", _os.path.join(self.spill_dir, "worker-{0}".format(index))]
+
+        if self.journal_dir is not None:
+            command += ["--journal", _os.path.join(self.journal_dir, "worker-{0}".format(index)),
+                        "--fsync", self.fsync,
+                        "--checkpoint-interval", str(self.checkpoint_interval)]
+
+        command += ["--idle-timeout", str(self.idle_timeout)]
+
+        if self.debug_enabled:
+            command.append("--debug")
+        elif self.verbose:
+            command.append("--verbose")
+        elif self.quiet:
+            command.append("--quiet")
+
+        return command
+
+    def _stop_workers(self):
+        for proc in self._worker_procs:
+            proc.terminate()
+
+        for proc in self._worker_procs:
+            proc.wait()
+
+        self._worker_procs = list()
+
+        if self._worker_dir and _os.path.exists(self._worker_dir):
+            _shutil.rmtree(self._worker_dir, ignore_errors=True)
+
+    def _worker_index(self, address):
+        # Each address belongs to exactly one worker, so its messages
+        # stay in order.  Wildcard subscriptions are relayed from every
+        # worker instead.
+        address = address.split("::", 1)[0]
+        address = self._worker_placements.get(address, address)
+        return _zlib.crc32(address.encode()) % len(self._worker_urls)
+
+    def _worker_url(self, address):
+        return self._worker_urls[self._worker_index(address)]
+
+    def _recover(self):
+        states, records = self._journal.recover()
+        nodes = list()
+
+        for state in states:
+            node = self._nodes.get(state["address"])
+
+            if node is None:
+                if state["type"] == "topic":
+                    node = self._create_topic(state["address"])
+                else:
+                    node = self._create_queue(state["address"])
+
+            nodes.append((node, state))
+
+        # Topic messages go back in log order, at their old offsets
+        records.sort(key=lambda x: -1 if x[2] is None else x[2])
+
+        for id, address, offset, appended, time, data in records:
+            message = _Message(data=data)
+            message.journal_id = id
+            message.offset = offset
+            message.appended = appended
+
+            node = self._get_node(address)
+
+            # Only messages still held at the restart are scheduled
+            # again, at their original due time
+            if time is None or not self._delay_store.add(address, message, time):
+                node.store_message(None, message)
+
+        for node, state in nodes:
+            node.restore(state)
+
+        self.notice("Recovered {0} messages from {1}", len(records), self._journal)
+
+    def _sync_journal(self):
+        self._journal.sync()
+
+    def _checkpoint(self):
+        self._journal.checkpoint(list(self._nodes.values()))
+
     def _get_node(self, address):
         try:
             node = self._nodes[address]
         except KeyError:
             node = self._create_queue(address)
+            node.auto_created = True
 
         return node
 
     def _create_queue(self, address):
         assert address not in self._nodes, address
 
+        self._routes.pop(address, None)
+
         node = _Queue(self, address)
         self._nodes[address] = node
 
@@ -169,300 +567,3386 @@ class Broker:
     def _create_topic(self, address):
         assert address not in self._nodes, address
 
+        self._routes.pop(address, None)
+
         node = _Topic(self, address)
         self._nodes[address] = node
 
         return node
 
-class _Queue:
-    def __init__(self, broker, address):
-        self.broker = broker
-        self.address = address
+    def _get_subscription(self, pattern):
+        try:
+            node = self._nodes[pattern]
+        except KeyError:
+            node = self._create_topic(pattern)
 
-        self.messages = _collections.deque()
-        self.consumers = _collections.deque()
+            self._subscriptions.add(pattern)
+            self._routes = dict()
 
-        self.broker.info("Created {0}", self)
+        return node
 
-    def __repr__(self):
-        return "queue '{0}'".format(self.address)
+    def _route(self, address):
+        # Returns the node for the address and the wildcard
+        # subscriptions it matches.  An address with no node of its own
+        # gets a queue only if no subscription matches it.  Routes are
+        # cached, so a message to a known address costs one lookup.
+        try:
+            return self._routes[address]
+        except KeyError:
+            pass
 
-    def add_consumer(self, link):
-        assert link.is_sender
-        assert link not in self.consumers
+        node = self._nodes.get(address)
+        subscriptions = [self._nodes[x] for x in self._subscriptions.match(address)]
 
-        self.consumers.append(link)
+        if node is None and not subscriptions:
+            node = self._create_queue(address)
+            node.auto_created = True
 
-        self.broker.info("Added consumer for {0} to {1}", _container_repr(link.connection), self)
+        if len(self._routes) >= 10000:
+            self._routes = dict()
 
-    def remove_consumer(self, link):
-        assert link.is_sender
+        route = self._routes[address] = (node, subscriptions)
 
-        try:
-            self.consumers.remove(link)
-        except ValueError:
-            return
+        return route
 
-        self.broker.info("Removed consumer for {0} from {1}", _container_repr(link.connection), self)
+    def _store_message(self, delivery, message, node, subscriptions):
+        if node is not None:
+            node.store_message(delivery, message)
+            self._dirty_nodes.add(node)
 
-    def store_message(self, delivery, message):
-        self.messages.append(message)
+        # Wildcard subscriptions are not journaled.  Each gets its own
+        # copy, since nodes keep their state on the message, but the
+        # copies share one encoding.
+        if subscriptions:
+            message.encode_once()
 
-        self.broker.notice("Stored {0} from {1} on {2}", message, _container_repr(delivery.connection), self)
+        for subscription in subscriptions:
+            subscription.store_message(delivery, _Message(data=message.data, message=message.message))
+            self._dirty_nodes.add(subscription)
 
-    def forward_messages(self):
-        credit = sum([x.credit for x in self.consumers])
-        sent = 0
+    def _add_consumer(self, link, node, selector=None, group=None, start=None):
+        node.add_consumer(link, selector, group, start)
+        self._connection_links[link.connection].add(link)
+        self._unsettled[link] = dict()
+
+    def _remove_consumer(self, link):
+        self._unindex_link(link)
 
-        if credit == 0:
+        unsettled = self._unsettled.pop(link, None)
+        address = link.source.address
+        node = self._nodes.get(address)
+
+        if node is None:
             return
 
-        while sent < credit:
-            for consumer in self.consumers:
-                if consumer.credit == 0:
-                    continue
+        node.remove_consumer(link)
 
-                try:
-                    message = self.messages.popleft()
-                except IndexError:
-                    self.consumers.rotate(sent)
-                    return
+        # The consumer may have failed while processing the oldest one,
+        # so it counts as a failed delivery.  The others were most
+        # likely only prefetched, so they go back as they were.
+        if unsettled:
+            messages = list(unsettled.values())
 
-                consumer.send(message)
-                sent += 1
+            node.settled(messages)
+            node.requeue(messages[1:], False)
+            node.requeue(messages[:1], True)
 
-                self.broker.notice("Forwarded {0} on {1} to {2}", message, self, _container_repr(consumer.connection))
+        # A wildcard subscription lasts as long as its consumers
+        if address in self._subscriptions and not node.consumers:
+            self._subscriptions.remove(address)
+            self._routes = dict()
 
-        self.consumers.rotate(sent)
+            self._delete_node(node)
+        elif node.owner == link:
+            self._delete_node(node)
 
-class _Topic(object):
-    def __init__(self, broker, address):
-        self.broker = broker
-        self.address = address
+    def _add_producer(self, link):
+        self._producers[link.target.address].add(link)
+        self._connection_links[link.connection].add(link)
 
-        self.messages = _collections.deque()
-        self.consumers = _collections.deque()
-        self.consumer_offsets = _collections.defaultdict(int)
+    def _remove_producer(self, link):
+        self._unindex_link(link)
 
-        self.broker.info("Created {0}", self)
+        producers = self._producers.get(link.target.address)
 
-    def __repr__(self):
-        return "topic '{0}'".format(self.address)
+        if producers is not None:
+            producers.discard(link)
 
-    def add_consumer(self, link):
-        assert link.is_sender
-        assert link not in self.consumers
+            if not producers:
+                del self._producers[link.target.address]
 
-        self.consumers.append(link)
+        node = self._nodes.get(link.target.address)
 
-        self.broker.info("Added consumer for {0} to {1}", _container_repr(link.connection), self)
+        if node is not None and node.owner == link:
+            self._delete_node(node)
 
-    def remove_consumer(self, link):
-        assert link.is_sender
+    def _delete_node(self, node):
+        del self._nodes[node.address]
+        self._routes.pop(node.address, None)
+        self._dirty_nodes.discard(node)
 
-        try:
-            self.consumers.remove(link)
-        except ValueError:
-            return
+        for message in node.messages:
+            if message.journal_id is not None and not message.taken:
+                self._journal.acknowledge(message.journal_id)
 
-        try:
-            del self.consumer_offsets[link]
-        except KeyError:
-            return
+        if isinstance(node.messages, _PagedDeque):
+            node.messages.clear()
 
-        self.broker.info("Removed consumer for {0} from {1}", _container_repr(link.connection), self)
+        self.info("Deleted {0}", node)
 
-    def store_message(self, delivery, message):
-        self.messages.append(message)
+    def _dispatch(self):
+        while self._dirty_nodes:
+            self._dirty_nodes.pop().forward_messages()
 
-        self.broker.notice("Stored {0} from {1} on {2}", message, _container_repr(delivery.connection), self)
+    def _evict_idle_nodes(self):
+        # A node is evicted once it has been idle for a whole interval,
+        # that is, at two sweeps in a row with no use in between
+        for node in list(self._nodes.values()):
+            if not node.auto_created or node.consumers or node.depth > 0 or node.address in self._producers:
+                node.idle = False
+            elif node.idle:
+                self._delete_node(node)
+            else:
+                node.idle = True
 
-    def forward_messages(self):
-        credit = sum([x.credit for x in self.consumers])
-        sent = 0
+    def get_metrics(self):
+        metrics = dict(self.metrics)
+        metrics["nodes"] = len(self._nodes)
+        metrics["scheduled_messages"] = len(self._delay_store)
 
-        if credit == 0:
-            return
+        return metrics
 
-        while sent < credit:
-            for consumer in self.consumers:
-                if consumer.credit == 0:
-                    continue
+    def _remove_links(self, connection):
+        for link in self._connection_links.pop(connection, ()):
+            if link.is_sender:
+                self._remove_consumer(link)
+            else:
+                self._remove_producer(link)
 
-                offset = self.consumer_offsets[consumer]
+    def _unindex_link(self, link):
+        links = self._connection_links.get(link.connection)
 
-                try:
-                    message = self.messages[offset]
-                except IndexError:
-                    self.consumers.rotate(sent)
-                    return
+        if links is not None:
+            links.discard(link)
 
-                consumer.send(message)
-                sent += 1
+            if not links:
+                del self._connection_links[link.connection]
 
-                self.consumer_offsets[consumer] += 1
+    def _grant_credit(self, link, node=None):
+        window = self.credit_window
 
-                self.broker.notice("Forwarded {0} on {1} to {2}", message, self, _container_repr(consumer.connection))
+        # Stay under the high watermark.  Several producers together can
+        # still overshoot it by up to their outstanding credit.
+        if node is not None and node.high_watermark is not None:
+            window = min(window, node.high_watermark - node.depth)
 
-        self.consumers.rotate(sent)
+        # Top up in batches, not on every message
+        if link.credit <= window // 2 and window > link.credit:
+            link.flow(window - link.credit)
 
-class _Handler(_handlers.MessagingHandler):
-    def __init__(self, broker):
-        super(_Handler, self).__init__()
+    def _resume_producers(self, address):
+        node = self._nodes[address]
 
-        self.broker = broker
+        for link in self._producers.get(address, ()):
+            self._grant_credit(link, node)
 
-    def on_start(self, event):
-        interface = "{0}:{1}".format(self.broker.host, self.broker.port)
+    def _track_expiry(self, node, message):
+        message.expiry = message.get_expiry()
 
-        if self.broker.cert is not None:
-            interface = "amqps://{0}".format(interface)
+        if message.expiry is not None:
+            self._expiry_wheel.add(node, message)
 
-            ssl_domain = event.container.ssl.server
-            ssl_domain.set_credentials(self.broker.cert, self.broker.key, None)
+    def _dead_letter(self, node, message, reason):
+        # Take a message off the dispatch path for good.  It moves to
+        # the dead-letter address of its queue, if there is one.
+        address = node.dead_letter_address
+        target = None if address is None else self._nodes.get(address)
 
-            if self.broker.trust:
-                ssl_domain.set_peer_authentication(_proton.SSLDomain.VERIFY_PEER, self.broker.trust)
-                ssl_domain.set_trusted_ca_db(self.broker.trust)
-            else:
-                ssl_domain.set_peer_authentication(_proton.SSLDomain.ANONYMOUS_PEER)
+        if target is None:
+            self.metrics["discarded_messages"] += 1
+            self.notice("Discarded {0} on {1}: {2}", message, node, reason)
+        else:
+            copy = _Message(data=message.data, message=message.message)
 
-        self.acceptor = event.container.listen(interface)
+            if self._journal is not None and copy.durable:
+                copy.journal_id = self._journal.enqueue(address, copy)
 
-        self.broker.notice("Listening for connections on '{0}'", interface)
+            target.store_message(None, copy)
+            self._dirty_nodes.add(target)
 
-        if self.broker.ready_file is not None:
-            with open(self.broker.ready_file, "w") as f:
-                f.write("ready\n")
+            self.metrics["dead_lettered_messages"] += 1
+            self.notice("Moved {0} from {1} to {2}: {3}", message, node, target, reason)
 
-    def on_link_opening(self, event):
-        if event.link.is_sender:
-            # A client receiving from the broker
+        if message.journal_id is not None:
+            self._journal.acknowledge(message.journal_id)
 
-            if event.link.remote_source.dynamic:
-                # A temporary queue
-                address = "{0}/{1}".format(event.connection.remote_container, event.link.name)
-                node = self.broker._create_queue(address)
-            elif event.link.remote_source.address in (None, ""):
-                raise Exception("The client created a receiver with no source address")
-            else:
-                # A named queue or topic
-                address = event.link.remote_source.address
-                node = self.broker._get_node(address)
+    def _drop_expired(self, node, message):
+        self.metrics["expired_messages"] += 1
 
-            assert address is not None
+        if message.journal_id is not None:
+            self._journal.acknowledge(message.journal_id)
+            message.journal_id = None
 
-            event.link.source.address = address
-            node.add_consumer(event.link)
+        self.notice("Expired {0} on {1}", message, node)
 
-        if event.link.is_receiver:
-            # A client sending to the broker
+    def _trim_topics(self):
+        for node in self._nodes.values():
+            if isinstance(node, _Topic) and node.retention is not None:
+                node.trim()
 
-            if event.link.remote_target.dynamic:
-                # A temporary queue
-                address = "{0}/{1}".format(event.connection.remote_container, event.link.name)
-                node = self.broker._create_queue(address)
-            elif event.link.remote_target.address in (None, ""):
-                # Anonymous relay - no queueing
-                address = None
-            else:
-                # A named queue or topic
-                address = event.link.remote_target.address
-                node = self.broker._get_node(address)
+class _AddressTrie:
+    # Wildcard address patterns, split into dot-separated words.  "*"
+    # matches exactly one word and "#" matches zero or more.  Matching
+    # walks one trie level per address word, so its cost depends on the
+    # address depth, not the number of patterns.
 
-            event.link.target.address = address
+    def __init__(self):
+        self.patterns = set()
+        self._root = _TrieNode()
 
-    def on_link_closing(self, event):
-        if event.link.is_sender:
-            node = self.broker._nodes[event.link.source.address]
-            node.remove_consumer(event.link)
+    def __contains__(self, pattern):
+        return pattern in self.patterns
 
-    def on_connection_opening(self, event):
-        # XXX I think this should happen automatically
-        event.connection.container = event.container.container_id
+    def add(self, pattern):
+        node = self._root
 
-    def on_connection_opened(self, event):
-        self.broker.notice("Opened connection from {0}", _container_repr(event.connection))
+        for word in pattern.split("."):
+            try:
+                node = node.children[word]
+            except KeyError:
+                node.children[word] = node = _TrieNode()
 
-    def on_connection_closing(self, event):
-        self.remove_consumers(event.connection)
+        node.pattern = pattern
+        self.patterns.add(pattern)
 
-    def on_connection_closed(self, event):
-        self.broker.notice("Closed connection from {0}", _container_repr(event.connection))
+    def remove(self, pattern):
+        words = pattern.split(".")
+        path = [self._root]
 
-    def on_disconnected(self, event):
-        self.broker.notice("Disconnected from {0}", _container_repr(event.connection))
+        for word in words:
+            path.append(path[-1].children[word])
 
-        self.remove_consumers(event.connection)
+        path[-1].pattern = None
+        self.patterns.discard(pattern)
 
-    def remove_consumers(self, connection):
-        link = connection.link_head(_proton.Endpoint.REMOTE_ACTIVE)
+        # Prune the branch back to the last node still in use
+        for i in range(len(words), 0, -1):
+            if path[i].children or path[i].pattern is not None:
+                break
 
-        while link is not None:
-            if link.is_sender:
-                node = self.broker._nodes[link.source.address]
-                node.remove_consumer(link)
+            del path[i - 1].children[words[i - 1]]
 
-            link = link.next(_proton.Endpoint.REMOTE_ACTIVE)
+    def match(self, address):
+        matches = set()
 
-    def on_link_flow(self, event):
-        if event.link.is_sender and event.link.drain_mode:
-            event.link.drained()
+        if self.patterns:
+            self._match(self._root, address.split("."), 0, matches)
 
-    def on_sendable(self, event):
-        node = self.broker._get_node(event.link.source.address)
-        node.forward_messages()
+        return matches
 
-    def on_settled(self, event):
-        template = "Client '{0}' {1} {2} for {3}"
-        client = event.connection.remote_container
-        source = _terminus_repr(event.link.source)
-        delivery = event.delivery
+    def _match(self, node, words, index, matches):
+        hash_node = node.children.get("#")
 
-        if delivery.remote_state == delivery.ACCEPTED:
-            self.broker.info(template, client, "accepted", _delivery_repr(delivery), source)
-        elif delivery.remote_state == delivery.REJECTED:
-            self.broker.warn(template, client, "rejected", _delivery_repr(delivery), source)
-        elif delivery.remote_state == delivery.RELEASED:
-            self.broker.notice(template, client, "released", _delivery_repr(delivery), source)
-        elif delivery.remote_state == delivery.MODIFIED:
-            self.broker.notice(template, client, "modified", _delivery_repr(delivery), source)
+        if hash_node is not None:
+            # Zero or more words
+            for i in range(index, len(words) + 1):
+                self._match(hash_node, words, i, matches)
 
-    def on_message(self, event):
-        message = event.message
-        delivery = event.delivery
-        address = event.link.target.address
+        if index == len(words):
+            if node.pattern is not None:
+                matches.add(node.pattern)
 
-        if address in (None, ""):
-            address = message.address
+            return
 
-        node = self.broker._get_node(address)
-        node.store_message(delivery, message)
-        node.forward_messages()
+        for word in (words[index], "*"):
+            child = node.children.get(word)
 
-    def on_unhandled(self, name, event):
-        self.broker.debug("Unhandled event: {0} {1}", name, event)
+            if child is not None:
+                self._match(child, words, index + 1, matches)
 
-def _container_repr(connection):
-    return "client '{0}'".format(connection.remote_container)
+class _TrieNode:
+    __slots__ = ("children", "pattern")
 
-def _terminus_repr(terminus):
-    return "terminus '{0}'".format(terminus.address)
+    def __init__(self):
+        self.children = dict()
+        self.pattern = None
 
-def _delivery_repr(delivery):
-    return "delivery '{0}'".format(delivery.tag)
+class _Timer:
+    def __init__(self, interval, function):
+        self.interval = interval
+        self.function = function
 
-def await_broker(ready_file, timeout=30):
-    start_time = _time.time()
-    interval = 0.125
+    def start(self, container):
+        container.schedule(self.interval, self)
 
-    while True:
-        if _time.time() - start_time > timeout:
-            raise Exception("Timed out waiting for the broker")
+    def on_timer_task(self, event):
+        self.function()
+        event.container.schedule(self.interval, self)
 
-        _time.sleep(interval)
+class _DelayStore:
+    # Messages scheduled for later delivery, in a heap ordered by due
+    # time.  They stay out of their queues until they are due, so a
+    # large number of them costs nothing at dispatch.
 
-        with open(ready_file, "r") as f:
+    def __init__(self, broker, resolution=0.1):
+        self.broker = broker
+        self.resolution = resolution
+
+        self._heap = list()
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, address, message, time=None):
+        # Returns false if the message is due now.  Recovered messages
+        # pass the due time the journal recorded for them.
+        if time is None:
+            time = message.get_delivery_time()
+
+        if time is None or time <= _time.time():
+            return False
+
+        # The sequence keeps messages due at the same time in order
+        self._sequence += 1
+        _heapq.heappush(self._heap, (time, self._sequence, address, message))
+
+        if message.journal_id is not None:
+            self.broker._journal.hold(address, message, time)
+
+        self.broker.notice("Scheduled {0} on '{1}' in {2:.3f} seconds", message, address, time - _time.time())
+
+        return True
+
+    def advance(self):
+        now = _time.time()
+
+        while self._heap and self._heap[0][0] <= now:
+            time, sequence, address, message = _heapq.heappop(self._heap)
+
+            if message.journal_id is not None:
+                self.broker._journal.release(message.journal_id)
+
+            # The nodes and subscriptions for the address may have
+            # changed while the message waited
+            node, subscriptions = self.broker._route(address)
+
+            if node is None and message.journal_id is not None:
+                self.broker._journal.acknowledge(message.journal_id)
+
+            self.broker._store_message(None, message, node, subscriptions)
+
+class _ExpiryWheel:
+    # Messages with a TTL, bucketed by the tick in which they expire.
+    # Adding a message and expiring it are constant time, and each
+    # advance visits only the buckets for the ticks that have passed.
+
+    def __init__(self, broker, resolution=0.25):
+        self.broker = broker
+        self.resolution = resolution
+
+        self._buckets = dict()
+        self._tick = int(_time.time() / self.resolution)
+
+    def add(self, node, message):
+        # Round up, so no message expires early
+        tick = max(int(message.expiry / self.resolution) + 1, self._tick)
+
+        try:
+            self._buckets[tick].append((node, message))
+        except KeyError:
+            self._buckets[tick] = [(node, message)]
+
+    def advance(self):
+        tick = int(_time.time() / self.resolution)
+        nodes = set()
+
+        while self._tick <= tick:
+            for node, message in self._buckets.pop(self._tick, ()):
+                # A deleted node has already dropped its messages
+                if self.broker._nodes.get(node.address) is not node:
+                    continue
+
+                # Queues clear the expiry of messages that were sent or
+                # spilled to disk
+                if message.expiry is not None and not message.expired:
+                    node.expire_message(message)
+                    nodes.add(node)
+
+            self._tick += 1
+
+        # Expiry can take a queue back under its low watermark
+        for node in nodes:
+            node.forward_messages()
+
+class _Queue:
+    def __init__(self, broker, address):
+        self.broker = broker
+        self.address = address
+
+        if self.broker.spill_after is None:
+            self.messages = _collections.deque()
+        else:
+            self.messages = _PagedDeque(self, self.broker.spill_after)
+
+        # Taken messages not yet removed from the message deque
+        self.dead = 0
+
+        # The link that created a dynamic queue, which is deleted when
+        # the link closes
+        self.owner = None
+
+        # Queues created on first use are evicted after a time with no
+        # messages, consumers, or producers
+        self.auto_created = False
+        self.idle = False
+
+        self.consumers = dict()
+        self.ready = _ReadySet()
+
+        # Consumers with selectors, grouped by selector text
+        self.selections = dict()
+        self.selected_consumers = dict()
+
+        # Producers get no more credit while the queue is blocked
+        self.high_watermark = None
+        self.low_watermark = None
+        self.blocked = False
+
+        # Rejected messages and those over the delivery limit move here
+        self.dead_letter_address = None
+
+        # For a partitioned queue, the partitions, which also hold its
+        # messages
+        self.partitions = None
+
+        self.broker.info("Created {0}", self)
+
+    def __repr__(self):
+        return "queue '{0}'".format(self.address)
+
+    @property
+    def depth(self):
+        return len(self.messages) - self.dead
+
+    def add_consumer(self, link, selector=None, group=None, start=None):
+        # Queue consumers already share the messages, so a consumer
+        # group needs nothing more.  Start positions apply only to
+        # topics.
+        assert link.is_sender
+        assert link not in self.consumers
+
+        self.consumers[link] = None
+
+        if selector is None:
+            self.ready.add(link)
+        else:
+            selection = self.selections.get(selector.text)
+
+            if selection is None:
+                selection = self._add_selection(selector)
+
+            selection.consumers += 1
+            selection.ready.add(link)
+
+            self.selected_consumers[link] = selection
+
+        self.broker.info("Added consumer for {0} to {1}", _container_repr(link.connection), self)
+
+        if self.partitions is not None:
+            self._assign_partitions()
+
+    def remove_consumer(self, link):
+        assert link.is_sender
+
+        try:
+            del self.consumers[link]
+        except KeyError:
+            return
+
+        selection = self.selected_consumers.pop(link, None)
+
+        if selection is None:
+            self.ready.remove(link)
+        else:
+            selection.consumers -= 1
+            selection.ready.remove(link)
+
+            if selection.consumers == 0:
+                del self.selections[selection.selector.text]
+
+        self.broker.info("Removed consumer for {0} from {1}", _container_repr(link.connection), self)
+
+        if self.partitions is not None:
+            self._assign_partitions()
+
+    def update_credit(self, link):
+        selection = self.selected_consumers.get(link)
+
+        if selection is None:
+            self.ready.update(link)
+        else:
+            selection.ready.update(link)
+
+    def checkpoint(self):
+        # The link that owns a dynamic queue does not survive a
+        # restart, so the queue comes back as one that idle eviction
+        # can collect
+        auto_created = self.auto_created or self.owner is not None
+
+        return {"type": "queue", "address": self.address, "auto_created": auto_created}
+
+    def restore(self, state):
+        self.auto_created = state.get("auto_created", False)
+
+    def store_message(self, delivery, message):
+        self.idle = False
+
+        # With nothing queued, a message for a consumer with credit,
+        # such as a reply, goes straight to it
+        if self.depth == 0 and self.ready.credit > 0 and not self.selections and self.partitions is None:
+            message.expiry = message.get_expiry()
+
+            if self._take(message):
+                self._send(self.ready, message)
+
+            return
+
+        self.messages.append(message)
+        self.broker._track_expiry(self, message)
+
+        for selection in self.selections.values():
+            if selection.selector.match(message):
+                selection.append(message, self.depth)
+
+        _log_stored(self.broker, delivery, message, self)
+
+        if self.high_watermark is not None and not self.blocked and self.depth >= self.high_watermark:
+            self.blocked = True
+            self.broker.notice("Blocked producers on {0} at {1} messages", self, self.depth)
+
+    def requeue(self, messages, failed):
+        # Put messages back at the head of the queue, in their original
+        # order.  The sent message stays taken, since it may still sit
+        # in the deque or a selection, so a copy goes back instead.
+        copies = list()
+        max_deliveries = self.broker.max_deliveries
+
+        for message in messages:
+            copy = _Message(data=message.data, message=message.message)
+            copy.journal_id = message.journal_id
+
+            if failed:
+                copy.add_failed_delivery()
+
+                if max_deliveries is not None and copy.delivery_count >= max_deliveries:
+                    self.broker._dead_letter(self, copy, "delivery failed {0} times".format(copy.delivery_count))
+                    continue
+
+            copies.append(copy)
+
+        for copy in reversed(copies):
+            self.messages.appendleft(copy)
+
+            # A last-value queue drops it if a newer message has its key
+            if copy.taken:
+                continue
+
+            self.broker._track_expiry(self, copy)
+
+            for selection in self.selections.values():
+                if selection.selector.match(copy):
+                    selection.messages.appendleft(copy)
+
+            if copy.journal_id is not None:
+                self.broker._journal.release(copy.journal_id)
+
+            self.broker.notice("Returned {0} to {1}", copy, self)
+
+        self.idle = False
+        self.broker._dirty_nodes.add(self)
+
+    def expire_message(self, message):
+        message.expired = True
+        message.taken = True
+
+        self.broker._drop_expired(self, message)
+        self._add_dead()
+
+    def forward_messages(self):
+        for selection in self.selections.values():
+            while selection.ready.credit > 0:
+                message = selection.next_message()
+
+                if message is None:
+                    break
+
+                live = self._take(message)
+
+                # The message stays in the message deque until it
+                # reaches the front
+                self._add_dead()
+
+                if live:
+                    self._send(selection.ready, message)
+
+        if self.partitions is None:
+            while self.ready.credit > 0 and self.messages:
+                message = self.messages.popleft()
+
+                if message.taken:
+                    self.dead -= 1
+                    continue
+
+                if self._take(message):
+                    self._send(self.ready, message)
+        else:
+            self._forward_partitions()
+
+        if self.blocked and self.depth <= self.low_watermark:
+            self.blocked = False
+            self.broker.notice("Unblocked producers on {0} at {1} messages", self, self.depth)
+            self.broker._resume_producers(self.address)
+
+    def _forward_partitions(self):
+        # Each partition goes only to its consumer, so messages with the
+        # same key stay in order
+        partitions = self.partitions
+
+        for index, consumer in enumerate(partitions.consumers):
+            if consumer is None or not partitions.sendable(index):
+                continue
+
+            while consumer.credit > 0 and partitions.queues[index]:
+                message = partitions.popleft(index)
+
+                if message.taken:
+                    self.dead -= 1
+                    continue
+
+                if self._take(message):
+                    self._send(self.ready, message, consumer)
+
+                    if consumer.snd_settle_mode != _proton.Link.SND_SETTLED:
+                        partitions.sent(index, consumer)
+
+    def settled(self, messages):
+        # A partition waiting for another consumer's deliveries may be
+        # free now
+        if self.partitions is not None:
+            for message in messages:
+                self.partitions.settled(message)
+
+            self.broker._dirty_nodes.add(self)
+
+    def _assign_partitions(self):
+        self.partitions.assign(list(self.consumers))
+        self.broker._dirty_nodes.add(self)
+
+        self.broker.info("Assigned {0} partitions on {1} to {2} consumers",
+                         len(self.partitions.queues), self, len(self.consumers))
+
+    def _add_selection(self, selector):
+        selection = _Selection(selector)
+
+        # Selections refer to the messages in memory
+        if isinstance(self.messages, _PagedDeque):
+            self.messages.load_pages()
+
+        for message in self.messages:
+            if not message.taken and selector.match(message):
+                selection.messages.append(message)
+
+        self.selections[selector.text] = selection
+
+        return selection
+
+    def _add_dead(self):
+        self.dead += 1
+
+        # Removing taken messages from the middle of the deque is a full
+        # pass, so wait until they are half of it
+        if self.dead * 2 > len(self.messages):
+            if isinstance(self.messages, _collections.deque):
+                self.messages = _collections.deque([x for x in self.messages if not x.taken])
+            else:
+                self.messages.remove_taken()
+
+            self.dead = 0
+
+    def _take(self, message):
+        # Returns false if the message expired since the last tick
+        message.taken = True
+
+        if message.expiry is not None:
+            if message.expiry <= _time.time():
+                message.expired = True
+                self.broker._drop_expired(self, message)
+                return False
+
+            message.expiry = None
+
+        return True
+
+    def _send(self, ready, message, consumer=None):
+        if consumer is None:
+            consumer = ready.next_link()
+
+        delivery = consumer.send(message)
+        ready.update(consumer)
+
+        if consumer.snd_settle_mode != _proton.Link.SND_SETTLED:
+            self.broker._unsettled[consumer][delivery] = message
+
+        if message.journal_id is not None:
+            self.broker._journal.track(delivery, self.address, message)
+
+        self.broker.notice("Forwarded {0} on {1} to {2}", message, self, _container_repr(consumer.connection))
+
+class _Selection:
+    # The messages on a queue that match a selector, in order, and the
+    # consumers using it.  Each stored message is matched once per
+    # selection, so dispatch never rescans the backlog.  Messages taken
+    # through the queue or another selection are skipped when they
+    # reach the front.
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.messages = _collections.deque()
+        self.ready = _ReadySet()
+        self.consumers = 0
+
+    def append(self, message, depth):
+        self.messages.append(message)
+
+        # At most depth of these are not yet taken, so this removes at
+        # least half
+        if len(self.messages) > 2 * depth + 16:
+            self.messages = _collections.deque([x for x in self.messages if not x.taken])
+
+    def next_message(self):
+        while self.messages:
+            message = self.messages.popleft()
+
+            if not message.taken:
+                return message
+
+class _PriorityDeque:
+    # One FIFO per priority level, plus a bitmap of the levels that
+    # hold messages, so finding the highest one is constant time
+
+    levels = 10
+
+    def __init__(self):
+        self._queues = [_collections.deque() for i in range(self.levels)]
+        self._bitmap = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for queue in reversed(self._queues):
+            yield from queue
+
+    def append(self, message):
+        level = min(message.priority, self.levels - 1)
+
+        self._queues[level].append(message)
+        self._bitmap |= 1 << level
+        self._length += 1
+
+    def appendleft(self, message):
+        level = min(message.priority, self.levels - 1)
+
+        self._queues[level].appendleft(message)
+        self._bitmap |= 1 << level
+        self._length += 1
+
+    def popleft(self):
+        if self._bitmap == 0:
+            raise IndexError("pop from an empty queue")
+
+        level = self._bitmap.bit_length() - 1
+        queue = self._queues[level]
+        message = queue.popleft()
+
+        if not queue:
+            self._bitmap &= ~(1 << level)
+
+        self._length -= 1
+
+        return message
+
+    def remove_taken(self):
+        for level, queue in enumerate(self._queues):
+            live = _collections.deque([x for x in queue if not x.taken])
+
+            self._length -= len(queue) - len(live)
+            self._queues[level] = live
+
+            if not live:
+                self._bitmap &= ~(1 << level)
+
+class _Partitions:
+    # The messages of a partitioned queue, in one FIFO per partition.
+    # A message goes to the partition for the hash of its key property,
+    # or of its group ID if it has none.  Each partition is assigned to
+    # one consumer.
+    #
+    # A partition that moves to another consumer is not sent from until
+    # the unsettled deliveries from it are settled or returned, so two
+    # consumers never hold messages with the same key at once.
+
+    def __init__(self, key, count):
+        self.key = key
+        self.queues = [_collections.deque() for i in range(count)]
+        self.consumers = [None] * count
+
+        # The consumer with unsettled deliveries from each partition,
+        # and how many
+        self.holders = [None] * count
+        self.unsettled = [0] * count
+
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for queue in self.queues:
+            yield from queue
+
+    def append(self, message):
+        self.queues[self._get_index(message)].append(message)
+        self._length += 1
+
+    def appendleft(self, message):
+        self.queues[self._get_index(message)].appendleft(message)
+        self._length += 1
+
+    def popleft(self, index):
+        message = self.queues[index].popleft()
+        self._length -= 1
+
+        return message
+
+    def remove_taken(self):
+        for index, queue in enumerate(self.queues):
+            live = _collections.deque([x for x in queue if not x.taken])
+
+            self._length -= len(queue) - len(live)
+            self.queues[index] = live
+
+    def sendable(self, index):
+        return self.unsettled[index] == 0 or self.holders[index] is self.consumers[index]
+
+    def sent(self, index, consumer):
+        self.holders[index] = consumer
+        self.unsettled[index] += 1
+
+    def settled(self, message):
+        index = self._get_index(message)
+
+        if self.unsettled[index] > 0:
+            self.unsettled[index] -= 1
+
+    def assign(self, consumers):
+        # Partitions stay with their consumer where they can.  Only
+        # those over a fair share, or whose consumer is gone, move, and
+        # they go to the consumers with the fewest.
+        if not consumers:
+            self.consumers = [None] * len(self.queues)
+            return
+
+        limit = -(-len(self.queues) // len(consumers))
+        counts = dict((x, 0) for x in consumers)
+        unassigned = list()
+
+        for index, consumer in enumerate(self.consumers):
+            if consumer in counts and counts[consumer] < limit:
+                counts[consumer] += 1
+            else:
+                unassigned.append(index)
+
+        for index in unassigned:
+            consumer = min(consumers, key=counts.get)
+
+            self.consumers[index] = consumer
+            counts[consumer] += 1
+
+    def _get_index(self, message):
+        value = message.properties.get(self.key)
+
+        if value is None:
+            value = message.group_id
+
+        if value is None:
+            return 0
+
+        return _zlib.crc32(str(value).encode()) % len(self.queues)
+
+class _LastValueDeque:
+    # A FIFO that keeps only the latest message for each value of the
+    # key property.  A newer message takes the place of the older one,
+    # so the backlog is bounded by the number of keys.  Messages without
+    # the property are all kept.
+
+    def __init__(self, node, key):
+        self.node = node
+        self.key = key
+
+        # By key value, or by the message itself if it has none
+        self._messages = _collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages.values())
+
+    def append(self, message):
+        key = self._get_key(message)
+        previous = self._messages.get(key)
+
+        # Assigning an existing key keeps its place in the order
+        self._messages[key] = message
+
+        if previous is not None:
+            self._replace(previous)
+
+    def appendleft(self, message):
+        key = self._get_key(message)
+
+        # A redelivered message is stale if a newer one has arrived
+        if key in self._messages:
+            self._replace(message)
+            return
+
+        self._messages[key] = message
+        self._messages.move_to_end(key, last=False)
+
+    def popleft(self):
+        try:
+            return self._messages.popitem(last=False)[1]
+        except KeyError:
+            raise IndexError("pop from an empty queue")
+
+    def remove_taken(self):
+        self._messages = _collections.OrderedDict([(k, v) for k, v in self._messages.items() if not v.taken])
+
+    def _get_key(self, message):
+        value = message.properties.get(self.key)
+
+        if value is None:
+            return message
+
+        return value
+
+    def _replace(self, message):
+        # Taken messages still here were counted as dead.  Others are
+        # marked taken, so selections skip them, and leave the journal.
+        if message.taken:
+            self.node.dead -= 1
+        else:
+            message.taken = True
+
+            if message.journal_id is not None:
+                self.node.broker._journal.acknowledge(message.journal_id)
+
+        message.expiry = None
+
+        self.node.broker.info("Replaced {0} on {1}", message, self.node)
+
+class _PagedDeque:
+    # A FIFO that keeps its head and tail in memory and, once it holds
+    # more than budget messages, pages the middle out to spill files.
+    # Pages are read back through a memory map, in order, as the head
+    # drains.
+
+    # Journal ID (0 for none), expiry time (0 for none), message length
+    _record = _struct.Struct(">QdI")
+
+    def __init__(self, node, budget, page_size=1024):
+        self.node = node
+        self.broker = node.broker
+        self.budget = budget
+        self.page_size = max(1, min(page_size, budget // 2))
+
+        self.head = _collections.deque()
+        self.pages = _collections.deque()
+        self.tail = _collections.deque()
+
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        yield from self.head
+
+        for path, count in self.pages:
+            yield from self._read_page(path)
+
+        yield from self.tail
+
+    def append(self, message):
+        self.tail.append(message)
+        self._length += 1
+
+        # Selections refer to the messages in memory, so nothing is
+        # spilled while the queue has any
+        if len(self.head) + len(self.tail) > self.budget and len(self.tail) >= self.page_size \
+           and not self.node.selections:
+            self._write_page()
+
+    def appendleft(self, message):
+        self.head.appendleft(message)
+        self._length += 1
+
+    def popleft(self):
+        if not self.head:
+            if self.pages:
+                self._load_page()
+            else:
+                self.head, self.tail = self.tail, self.head
+
+        message = self.head.popleft()
+        self._length -= 1
+
+        return message
+
+    def clear(self):
+        for path, count in self.pages:
+            _os.remove(path)
+
+        self.head.clear()
+        self.pages.clear()
+        self.tail.clear()
+
+        self._length = 0
+
+    def load_pages(self):
+        while self.pages:
+            self._load_page()
+
+    def remove_taken(self):
+        # Spilled pages never hold taken messages
+        length = len(self.head) + len(self.tail)
+
+        self.head = _collections.deque([x for x in self.head if not x.taken])
+        self.tail = _collections.deque([x for x in self.tail if not x.taken])
+
+        self._length -= length - len(self.head) - len(self.tail)
+
+    def _write_page(self):
+        fd, path = _tempfile.mkstemp(suffix=".page", dir=self.broker._spill_dir)
+        count = 0
+
+        with _os.fdopen(fd, "wb") as f:
+            for i in range(self.page_size):
+                message = self.tail.popleft()
+
+                if message.taken:
+                    self.node.dead -= 1
+                    self._length -= 1
+                    continue
+
+                data = message.encode()
+
+                f.write(self._record.pack(message.journal_id or 0, message.expiry or 0, len(data)))
+                f.write(data)
+
+                # The copy read back from the page replaces this one
+                message.expiry = None
+                count += 1
+
+        if count == 0:
+            _os.remove(path)
+            return
+
+        self.pages.append((path, count))
+
+        self.broker.debug("Spilled {0} messages to {1}", count, path)
+
+    def _read_page(self, path):
+        messages = list()
+
+        with open(path, "rb") as f:
+            with _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ) as data:
+                pos = 0
+
+                while pos < len(data):
+                    journal_id, expiry, length = self._record.unpack_from(data, pos)
+                    pos += self._record.size
+
+                    message = _Message(data=data[pos:pos + length])
+                    pos += length
+
+                    if journal_id != 0:
+                        message.journal_id = journal_id
+
+                    if expiry != 0:
+                        message.expiry = expiry
+
+                    messages.append(message)
+
+        return messages
+
+    def _load_page(self):
+        path, count = self.pages.popleft()
+        messages = self._read_page(path)
+
+        for message in messages:
+            if message.expiry is not None:
+                self.broker._expiry_wheel.add(self.node, message)
+
+        self.head.extend(messages)
+        _os.remove(path)
+
+        self.broker.debug("Loaded {0} messages from {1}", count, path)
+
+class _ReadySet:
+    # Consumer links that have credit, in round-robin order, and their
+    # total credit.  Callers report credit changes using update().
+
+    def __init__(self):
+        self.credit = 0
+
+        self._links = _collections.OrderedDict()
+        self._credits = dict()
+
+    def __len__(self):
+        return len(self._links)
+
+    def __iter__(self):
+        return iter(list(self._links))
+
+    def add(self, link):
+        self._credits[link] = 0
+        self.update(link)
+
+    def remove(self, link):
+        self.credit -= self._credits.pop(link, 0)
+        self._links.pop(link, None)
+
+    def update(self, link):
+        try:
+            previous = self._credits[link]
+        except KeyError:
+            return
+
+        credit = link.credit
+
+        self._credits[link] = credit
+        self.credit += credit - previous
+
+        if credit > 0:
+            self._links[link] = None
+        else:
+            self._links.pop(link, None)
+
+    def next_link(self):
+        link = next(iter(self._links))
+        self._links.move_to_end(link)
+
+        return link
+
+class _Log:
+    # An append-only sequence addressed by absolute offset.  Items are
+    # held in fixed-size segments, so lookups are constant time and
+    # appends never copy existing items.  The append time of each item
+    # is kept alongside, so finding the first item after a given time
+    # is a binary search.
+
+    def __init__(self, segment_size=1024):
+        self.segment_size = segment_size
+        self.start = 0
+        self.end = 0
+
+        self._segments = dict()
+        self._times = dict()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, offset):
+        if offset < self.start or offset >= self.end:
+            raise IndexError(offset)
+
+        index, slot = divmod(offset, self.segment_size)
+
+        return self._segments[index][slot]
+
+    def __iter__(self):
+        for offset in range(self.start, self.end):
+            yield self[offset]
+
+    def append(self, item, time=None):
+        index, slot = divmod(self.end, self.segment_size)
+
+        if time is None:
+            time = _time.time()
+
+        try:
+            segment = self._segments[index]
+        except KeyError:
+            segment = self._segments[index] = [None] * self.segment_size
+            self._times[index] = _array.array("d", [0.0]) * self.segment_size
+
+        segment[slot] = item
+        self._times[index][slot] = time
+        self.end += 1
+
+        return self.end - 1
+
+    def find(self, time):
+        # Returns the offset of the first item appended at or after
+        # time, or the end offset if there is none
+        if self.start == self.end:
+            return self.end
+
+        # The last segment whose first item is before time
+        low = self.start // self.segment_size
+        high = (self.end - 1) // self.segment_size
+
+        while low < high:
+            middle = (low + high + 1) // 2
+
+            if self._times[middle][0] < time:
+                low = middle
+            else:
+                high = middle - 1
+
+        base = low * self.segment_size
+        first = max(self.start - base, 0)
+        last = min(self.end - base, self.segment_size)
+
+        return base + _bisect.bisect_left(self._times[low], time, first, last)
+
+    def trim(self, offset):
+        offset = min(offset, self.end)
+
+        if offset <= self.start:
+            return
+
+        first = self.start // self.segment_size
+        last = offset // self.segment_size
+
+        for index in range(first, last):
+            self._segments.pop(index, None)
+            self._times.pop(index, None)
+
+        segment = self._segments.get(last)
+
+        if segment is not None:
+            base = last * self.segment_size
+
+            for slot in range(max(self.start - base, 0), offset - base):
+                segment[slot] = None
+
+        self.start = offset
+
+    def reset(self, offset):
+        assert len(self) == 0
+
+        self.start = offset
+        self.end = offset
+
+class _Retention:
+    # Topic retention limits.  The policy is a comma-separated list of
+    # count:N, bytes:N, age:SECONDS, and slowest, the last of which
+    # drops messages every consumer has already received, including
+    # detached durable subscribers and groups with no members.
+
+    def __init__(self, policy):
+        self.policy = policy
+
+        self.max_count = None
+        self.max_bytes = None
+        self.max_age = None
+        self.slowest = False
+
+        for item in policy.split(","):
+            name, _, value = item.strip().partition(":")
+
+            if name == "count":
+                self.max_count = int(value)
+            elif name == "bytes":
+                self.max_bytes = int(value)
+            elif name == "age":
+                self.max_age = float(value)
+            elif name == "slowest" and not value:
+                self.slowest = True
+            else:
+                raise ValueError("Unknown policy item '{0}'".format(item))
+
+        self.bytes = 0
+
+        # (size, time) for each retained message, used by the byte
+        # and age limits
+        self._entries = _collections.deque()
+
+    def __repr__(self):
+        return "retention '{0}'".format(self.policy)
+
+    @property
+    def tracking(self):
+        return self.max_bytes is not None or self.max_age is not None
+
+    def record(self, message, time):
+        if not self.tracking:
+            return
+
+        size = 0
+
+        if self.max_bytes is not None:
+            size = len(message.encode())
+
+        self._entries.append((size, time))
+        self.bytes += size
+
+    def get_start(self, log, slowest_offset):
+        start = log.start
+
+        if self.max_count is not None:
+            start = max(start, log.end - self.max_count)
+
+        if self.slowest:
+            start = max(start, slowest_offset)
+
+        if not self.tracking:
+            return start
+
+        for i in range(start - log.start):
+            size, _ = self._entries.popleft()
+            self.bytes -= size
+
+        now = _time.time()
+
+        while self._entries:
+            size, time = self._entries[0]
+
+            over_bytes = self.max_bytes is not None and self.bytes > self.max_bytes
+            over_age = self.max_age is not None and now - time > self.max_age
+
+            if not (over_bytes or over_age):
+                break
+
+            self._entries.popleft()
+            self.bytes -= size
+            start += 1
+
+        return start
+
+class _Topic(object):
+    def __init__(self, broker, address):
+        self.broker = broker
+        self.address = address
+
+        self.messages = _Log()
+        self.consumers = dict()
+        self.consumer_offsets = _collections.defaultdict(int)
+        self.ready = _ReadySet()
+        self.selectors = dict()
+
+        # Consumer groups by name, and the group of each group member.
+        # Groups keep their offset when their last member leaves.
+        self.groups = dict()
+        self.consumer_groups = dict()
+
+        # The container ID and link name of each durable subscriber
+        self.durable_keys = dict()
+
+        # The offsets of durable subscribers that are not attached, by
+        # container ID and link name.  They are kept across reconnects
+        # and journal checkpoints.
+        self.saved_offsets = dict()
+
+        self.retention = None
+        self.high_watermark = None
+        self.blocked = False
+
+        self.owner = None
+        self.auto_created = False
+
+        self.broker.info("Created {0}", self)
+
+    def __repr__(self):
+        return "topic '{0}'".format(self.address)
+
+    def add_consumer(self, link, selector=None, group=None, start=None):
+        assert link.is_sender
+        assert link not in self.consumers
+
+        self.consumers[link] = None
+
+        if group is not None:
+            self._add_group_member(link, group, start)
+            return
+
+        offset = None
+
+        if link.remote_source.durability != _proton.Terminus.NONDURABLE:
+            # A durable subscriber resumes where it left off
+            key = self.durable_keys[link] = _link_key(link)
+            offset = self.saved_offsets.pop(key, None)
+
+        if offset is None:
+            offset = self._start_offset(start)
+
+        self.consumer_offsets[link] = offset
+        self.ready.add(link)
+
+        if selector is not None:
+            self.selectors[link] = selector
+
+        self.broker.info("Added consumer for {0} to {1}", _container_repr(link.connection), self)
+
+    def _add_group_member(self, link, name, start):
+        try:
+            group = self.groups[name]
+        except KeyError:
+            group = self.groups[name] = _ConsumerGroup(name, self._start_offset(start))
+
+        self.consumer_groups[link] = group
+        group.ready.add(link)
+        group.members += 1
+
+        self.broker.info("Added consumer for {0} to {1} on {2}", _container_repr(link.connection), group, self)
+
+    def remove_consumer(self, link):
+        assert link.is_sender
+
+        try:
+            del self.consumers[link]
+        except KeyError:
+            return
+
+        group = self.consumer_groups.pop(link, None)
+
+        if group is not None:
+            group.ready.remove(link)
+            group.members -= 1
+
+            self.broker.info("Removed consumer for {0} from {1} on {2}", _container_repr(link.connection), group, self)
+            return
+
+        self.ready.remove(link)
+        self.selectors.pop(link, None)
+
+        try:
+            offset = self.consumer_offsets.pop(link)
+        except KeyError:
+            return
+
+        key = self.durable_keys.pop(link, None)
+
+        if key is not None:
+            self.saved_offsets[key] = offset
+            self._offsets_changed()
+
+        self.broker.info("Removed consumer for {0} from {1}", _container_repr(link.connection), self)
+
+    def _start_offset(self, start):
+        # Start is None for the oldest retained message, "now" for the
+        # next new message, or a time in seconds since the epoch
+        if start is None:
+            return self.messages.start
+
+        if start == "now":
+            return self.messages.end
+
+        return self.messages.find(start)
+
+    def store_message(self, delivery, message):
+        # Encode once, so each consumer's delivery reuses the same bytes
+        message.encode_once()
+
+        # A recovered message keeps its old offset, so saved consumer
+        # offsets still point at the same messages.  It keeps its old
+        # append time too, for start positions and the age limit.
+        offset = message.offset
+
+        if offset is not None:
+            self._skip_to(offset, message.appended)
+
+        if message.appended is None:
+            message.appended = _time.time()
+
+        message.offset = self.messages.append(message, message.appended)
+        self.broker._track_expiry(self, message)
+
+        if message.journal_id is not None and message.offset != offset:
+            self.broker._journal.place(message.journal_id, message.offset, message.appended)
+
+        _log_stored(self.broker, delivery, message, self)
+
+        if self.retention is not None:
+            self.retention.record(message, message.appended)
+
+            # Finding the slowest consumer walks the consumer list, so
+            # that policy is applied once per log segment
+            if not self.retention.slowest or self.messages.end % self.messages.segment_size == 0:
+                self.trim()
+
+    def _skip_to(self, offset, time=None):
+        if offset <= self.messages.end:
+            return
+
+        if len(self.messages) == 0:
+            self.messages.reset(offset)
+            return
+
+        # The offsets in between held messages that were not durable or
+        # are gone.  They are filled with an expired placeholder, which
+        # consumers skip, appended at the time of the message after it.
+        gap = _Message(data=b"")
+        gap.expired = True
+        gap.appended = _time.time() if time is None else time
+
+        while self.messages.end < offset:
+            self.messages.append(gap, gap.appended)
+
+            if self.retention is not None:
+                self.retention.record(gap, gap.appended)
+
+    def trim(self):
+        slowest_offset = self.messages.end
+
+        if self.retention.slowest:
+            offsets = [self.consumer_offsets[x] for x in self.consumers if x not in self.consumer_groups]
+            offsets += [x.offset for x in self.groups.values()]
+            offsets += self.saved_offsets.values()
+
+            if offsets:
+                slowest_offset = min(offsets)
+
+        start = self.retention.get_start(self.messages, slowest_offset)
+
+        if start > self.messages.start:
+            self.broker.info("Trimmed {0} messages from {1} using {2}", start - self.messages.start, self, self.retention)
+
+            if self.broker._journal is not None:
+                for offset in range(self.messages.start, min(start, self.messages.end)):
+                    message = self.messages[offset]
+
+                    if message.journal_id is not None:
+                        self.broker._journal.acknowledge(message.journal_id)
+
+            self.messages.trim(start)
+
+    def expire_message(self, message):
+        # Expired messages stay in the log until retention trims them,
+        # but are no longer sent
+        message.expired = True
+        self.broker._drop_expired(self, message)
+
+    def update_credit(self, link):
+        group = self.consumer_groups.get(link)
+
+        if group is None:
+            self.ready.update(link)
+        else:
+            group.ready.update(link)
+
+    def checkpoint(self):
+        offsets = dict(self.saved_offsets)
+
+        for link, key in self.durable_keys.items():
+            offsets[key] = self.consumer_offsets[link]
+
+        group_offsets = dict((x.name, x.offset) for x in self.groups.values())
+
+        return {"type": "topic", "address": self.address, "end": self.messages.end,
+                "consumer_offsets": offsets, "group_offsets": group_offsets}
+
+    def restore(self, state):
+        # New messages take the offsets after the checkpointed ones, so
+        # saved offsets never point past them
+        self._skip_to(state.get("end", 0))
+        self.saved_offsets.update(state.get("consumer_offsets", {}))
+
+        for name, offset in state.get("group_offsets", {}).items():
+            self.groups[name] = _ConsumerGroup(name, offset)
+
+    def forward_messages(self):
+        for consumer in self.ready:
+            # Offsets are absolute, so a consumer that fell behind the
+            # retained messages resumes at the oldest one
+            offset = max(self.consumer_offsets[consumer], self.messages.start)
+            selector = self.selectors.get(consumer)
+
+            while consumer.credit > 0 and offset < self.messages.end:
+                message = self.messages[offset]
+                offset += 1
+
+                if message.expired:
+                    continue
+
+                if selector is not None and not selector.match(message):
+                    continue
+
+                consumer.send(message)
+
+                self.broker.notice("Forwarded {0} on {1} to {2}", message, self, _container_repr(consumer.connection))
+
+            if consumer in self.durable_keys and offset != self.consumer_offsets[consumer]:
+                self._offsets_changed()
+
+            self.consumer_offsets[consumer] = offset
+            self.ready.update(consumer)
+
+        for group in self.groups.values():
+            if group.ready.credit > 0:
+                self._forward_group_messages(group)
+
+    def _forward_group_messages(self, group):
+        # The group shares one offset, and each message goes to the
+        # next member with credit
+        offset = max(group.offset, self.messages.start)
+
+        while group.ready.credit > 0 and offset < self.messages.end:
+            message = self.messages[offset]
+            offset += 1
+
+            if message.expired:
+                continue
+
+            consumer = group.ready.next_link()
+            consumer.send(message)
+            group.ready.update(consumer)
+
+            self.broker.notice("Forwarded {0} on {1} to {2}", message, self, _container_repr(consumer.connection))
+
+        if offset != group.offset:
+            self._offsets_changed()
+
+        group.offset = offset
+
+    def _offsets_changed(self):
+        # Saved offsets are part of checkpoints, so the next one is
+        # written even if no messages arrive
+        if self.broker._journal is not None:
+            self.broker._journal.note_change()
+
+class _ConsumerGroup:
+    def __init__(self, name, offset=0):
+        self.name = name
+        self.offset = offset
+        self.ready = _ReadySet()
+        self.members = 0
+
+    def __repr__(self):
+        return "group '{0}'".format(self.name)
+
+class _Journal:
+    # An append-only record of durable messages and their
+    # acknowledgments, kept in numbered segment files.  Under the tick
+    # and interval fsync policies, incoming durable messages are
+    # accepted only after a sync covers them, so one fsync commits a
+    # whole group of messages.  Scheduled messages also get a record of
+    # the time they are due.
+    #
+    # A checkpoint starts a new segment and writes a snapshot of the
+    # live messages and node state.  Recovery reads the latest snapshot
+    # and the segments after it, and earlier files are removed.
+    # Between checkpoints, compact() removes the oldest segments once
+    # all of their messages are acknowledged.  Acknowledgments for
+    # messages in the snapshot are only in the segments after it, so
+    # while the snapshot holds messages, those segments are kept until
+    # the next checkpoint.
+
+    ENQUEUE = 1
+    ACKNOWLEDGE = 2
+    NODE = 3
+    OFFSET = 4
+    HOLD = 5
+
+    # Record length, record type, message ID
+    _header = _struct.Struct(">IBQ")
+    _address_length = _struct.Struct(">H")
+
+    # The message's offset in a topic log and the time it was appended
+    # there, or -1 and 0 for none
+    _placement = _struct.Struct(">qd")
+
+    # The time a scheduled message is due, in seconds since the epoch
+    _due_time = _struct.Struct(">d")
+
+    def __init__(self, broker, dir, fsync="tick", segment_size=16 * 1024 * 1024):
+        self.broker = broker
+        self.dir = dir
+        self.fsync = fsync
+        self.segment_size = segment_size
+
+        self.next_id = 1
+
+        self._segment_index = 0
+        self._segments = _collections.deque()
+        self._file = None
+        self._dirty = False
+        self._changed = False
+        self._waiting = list()
+
+        # Unacknowledged messages per segment, for compaction
+        self._live_counts = _collections.Counter()
+        self._id_segments = dict()
+
+        # The first segment after a snapshot that holds messages
+        self._pinned_segment = None
+
+        # Messages on no node, because they are forwarded but not yet
+        # settled or scheduled for later, for checkpoints
+        self._in_flight = dict()
+
+        # Due times of the scheduled messages
+        self._held = dict()
+
+    def __repr__(self):
+        return "journal '{0}'".format(self.dir)
+
+    def _path(self, index, extension):
+        return _os.path.join(self.dir, "{0:012d}{1}".format(index, extension))
+
+    def _indexes(self, extension):
+        names = [x for x in _os.listdir(self.dir) if x.endswith(extension)]
+        return sorted([int(x[:-len(extension)]) for x in names])
+
+    def _read_records(self, path):
+        with open(path, "rb") as f:
+            data = memoryview(f.read())
+
+        pos = 0
+
+        while pos + self._header.size <= len(data):
+            length, type, id = self._header.unpack_from(data, pos)
+            end = pos + 4 + length
+
+            # A record cut short by a crash ends the file
+            if end > len(data):
+                break
+
+            self.next_id = max(self.next_id, id + 1)
+
+            yield type, id, data[pos + self._header.size:end]
+
+            pos = end
+
+    def _encode_record(self, type, id, payload=b""):
+        return self._header.pack(self._header.size - 4 + len(payload), type, id) + payload
+
+    def _encode_enqueue(self, address, message):
+        address = address.encode()
+        offset = -1 if message.offset is None else message.offset
+        appended = message.appended or 0.0
+
+        return b"".join((self._address_length.pack(len(address)), address,
+                         self._placement.pack(offset, appended), message.encode()))
+
+    def _decode_enqueue(self, payload):
+        address_length = self._address_length.unpack_from(payload, 0)[0]
+        start = self._address_length.size
+        address = bytes(payload[start:start + address_length]).decode()
+
+        start += address_length
+        offset, appended = self._decode_placement(payload[start:])
+        start += self._placement.size
+
+        return [address, offset, appended, bytes(payload[start:])]
+
+    def _decode_placement(self, payload):
+        offset, appended = self._placement.unpack_from(payload, 0)
+
+        if offset < 0:
+            return None, None
+
+        return offset, appended
+
+    def recover(self):
+        _os.makedirs(self.dir, exist_ok=True)
+
+        states = list()
+        messages = dict()
+        times = dict()
+        snapshots = self._indexes(".snapshot")
+        start = 0
+
+        if snapshots:
+            start = snapshots[-1]
+
+            for type, id, payload in self._read_records(self._path(start, ".snapshot")):
+                if type == self.NODE:
+                    states.append(_json.loads(bytes(payload).decode()))
+                elif type == self.ENQUEUE:
+                    messages[id] = self._decode_enqueue(payload)
+                    self._pinned_segment = start
+                elif type == self.HOLD:
+                    times[id] = self._due_time.unpack_from(payload, 0)[0]
+
+        for index in self._indexes(".journal"):
+            if index < start:
+                _os.remove(self._path(index, ".journal"))
+                continue
+
+            for type, id, payload in self._read_records(self._path(index, ".journal")):
+                if type == self.ENQUEUE:
+                    messages[id] = self._decode_enqueue(payload)
+
+                    self._id_segments[id] = index
+                    self._live_counts[index] += 1
+                elif type == self.ACKNOWLEDGE:
+                    messages.pop(id, None)
+                    times.pop(id, None)
+                    self._forget(id)
+                elif type == self.OFFSET:
+                    if id in messages:
+                        messages[id][1:3] = self._decode_placement(payload)
+                elif type == self.HOLD:
+                    if id in messages:
+                        times[id] = self._due_time.unpack_from(payload, 0)[0]
+
+            self._segments.append(index)
+            self._segment_index = index + 1
+
+        for index in snapshots[:-1]:
+            _os.remove(self._path(index, ".snapshot"))
+
+        self._open_segment()
+
+        return states, [(id, address, offset, appended, times.get(id), data)
+                        for id, (address, offset, appended, data) in messages.items()]
+
+    def _open_segment(self):
+        self._file = open(self._path(self._segment_index, ".journal"), "ab")
+        self._segments.append(self._segment_index)
+        self._segment_index += 1
+
+    def _rotate(self):
+        self.sync()
+        self._file.close()
+        self._open_segment()
+
+    def _write(self, type, id, payload=b""):
+        self._file.write(self._encode_record(type, id, payload))
+        self._dirty = True
+        self._changed = True
+
+        if self.fsync == "always":
+            self.sync()
+
+        if self._file.tell() >= self.segment_size:
+            self._rotate()
+
+    def _forget(self, id):
+        index = self._id_segments.pop(id, None)
+
+        if index is not None:
+            self._live_counts[index] -= 1
+
+    def enqueue(self, address, message):
+        id = self.next_id
+        self.next_id += 1
+
+        self._write(self.ENQUEUE, id, self._encode_enqueue(address, message))
+
+        self._id_segments[id] = self._segments[-1]
+        self._live_counts[self._segments[-1]] += 1
+
+        return id
+
+    def note_change(self):
+        self._changed = True
+
+    def place(self, id, offset, appended):
+        # Record where and when a message landed in its topic log
+        self._write(self.OFFSET, id, self._placement.pack(offset, appended))
+
+    def acknowledge(self, id):
+        self._write(self.ACKNOWLEDGE, id)
+
+        self._in_flight.pop(id, None)
+        self._held.pop(id, None)
+        self._forget(id)
+
+    def hold(self, address, message, time):
+        # Record when a scheduled message is due, so recovery neither
+        # delays it again nor holds back one already released
+        self._write(self.HOLD, message.journal_id, self._due_time.pack(time))
+
+        self._in_flight[message.journal_id] = address, message
+        self._held[message.journal_id] = time
+
+    def release(self, id):
+        # The message is on its node again, so checkpoints find it there
+        self._in_flight.pop(id, None)
+        self._held.pop(id, None)
+
+    def track(self, delivery, address, message):
+        # Acknowledge the message when the consumer settles it
+        if delivery.link.snd_settle_mode == _proton.Link.SND_SETTLED:
+            self.acknowledge(message.journal_id)
+        else:
+            delivery.journal_id = message.journal_id
+            self._in_flight[message.journal_id] = address, message
+
+    def accept_when_synced(self, delivery):
+        if self.fsync in ("always", "never"):
+            delivery.update(delivery.ACCEPTED)
+            delivery.settle()
+        else:
+            self._waiting.append(delivery)
+
+    def sync(self):
+        if not self._dirty:
+            return
+
+        self._file.flush()
+
+        if self.fsync != "never":
+            _os.fsync(self._file.fileno())
+
+        self._dirty = False
+
+        for delivery in self._waiting:
+            delivery.update(delivery.ACCEPTED)
+            delivery.settle()
+
+        self._waiting = list()
+
+    def checkpoint(self, nodes):
+        if not self._changed:
+            return
+
+        self._rotate()
+        self._changed = False
+
+        index = self._segments[-1]
+        path = self._path(index, ".snapshot")
+        temp = path + ".temp"
+        count = 0
+
+        with open(temp, "wb") as f:
+            for node in nodes:
+                f.write(self._encode_record(self.NODE, 0, _json.dumps(node.checkpoint()).encode()))
+
+                for message in node.messages:
+                    if message.journal_id is not None and not message.taken:
+                        f.write(self._encode_record(self.ENQUEUE, message.journal_id,
+                                                    self._encode_enqueue(node.address, message)))
+                        count += 1
+
+            for id, (address, message) in self._in_flight.items():
+                f.write(self._encode_record(self.ENQUEUE, id, self._encode_enqueue(address, message)))
+                count += 1
+
+                if id in self._held:
+                    f.write(self._encode_record(self.HOLD, id, self._due_time.pack(self._held[id])))
+
+            f.flush()
+            _os.fsync(f.fileno())
+
+        _os.replace(temp, path)
+
+        self._pinned_segment = index if count > 0 else None
+
+        # Everything before the new segment is now in the snapshot
+        while self._segments[0] != index:
+            old = self._segments.popleft()
+            _os.remove(self._path(old, ".journal"))
+            del self._live_counts[old]
+
+        self._id_segments = dict()
+
+        for old in self._indexes(".snapshot"):
+            if old != index:
+                _os.remove(self._path(old, ".snapshot"))
+
+        self.broker.info("Wrote a checkpoint of {0} messages to {1}", count, self)
+
+    def compact(self):
+        while len(self._segments) > 1 and self._live_counts[self._segments[0]] == 0:
+            if self._segments[0] == self._pinned_segment:
+                break
+
+            old = self._segments.popleft()
+            _os.remove(self._path(old, ".journal"))
+            del self._live_counts[old]
+
+            self.broker.info("Removed acknowledged segment {0} from {1}", old, self)
+
+class _Handler(_handlers.MessagingHandler):
+    def __init__(self, broker):
+        # Producer credit is granted by the broker, not by prefetch
+        super(_Handler, self).__init__(prefetch=0, auto_accept=False)
+
+        self.broker = broker
+
+    def on_start(self, event):
+        self.acceptor = self.broker._listen(event.container)
+
+        for timer in self.broker._timers:
+            timer.start(event.container)
+
+        self.broker._write_ready_file()
+
+    def on_link_opening(self, event):
+        if event.link.is_sender:
+            # A client receiving from the broker
+
+            if event.link.remote_source.dynamic:
+                address = "{0}/{1}".format(event.connection.remote_container, event.link.name)
+            elif event.link.remote_source.address in (None, ""):
+                raise Exception("The client created a receiver with no source address")
+            else:
+                address = event.link.remote_source.address
+
+            assert address is not None
+
+            # ADDRESS::GROUP joins a consumer group on ADDRESS
+            group = None
+
+            if not event.link.remote_source.dynamic and "::" in address:
+                address, group = address.split("::", 1)
+
+            event.link.source.address = address
+
+            # At-most-once consumers get presettled deliveries
+            event.link.snd_settle_mode = event.link.remote_snd_settle_mode
+
+            try:
+                selector = _get_selector(event.link)
+            except ValueError as e:
+                # The link is closed once it is open
+                event.link.condition = _proton.Condition("amqp:invalid-field", "Invalid selector: {0}".format(e))
+                return
+
+            if group is not None and selector is not None:
+                event.link.condition = _proton.Condition("amqp:not-implemented", "Consumer groups do not support selectors")
+                return
+
+            try:
+                start = _get_start(event.link)
+            except ValueError as e:
+                event.link.condition = _proton.Condition("amqp:invalid-field", "Invalid start position: {0}".format(e))
+                return
+
+            if address == "$metrics":
+                # Broker metrics, sent on demand
+                return
+
+            if event.link.remote_source.dynamic:
+                # A temporary queue
+                node = self.broker._create_queue(address)
+                node.owner = event.link
+            elif _is_pattern(address):
+                # A wildcard subscription
+                node = self.broker._get_subscription(address)
+            else:
+                # A named queue or topic
+                node = self.broker._get_node(address)
+
+            if selector is not None and isinstance(node, _Queue) and node.partitions is not None:
+                event.link.condition = _proton.Condition("amqp:not-implemented", "Partitioned queues do not support selectors")
+                return
+
+            self.broker._add_consumer(event.link, node, selector, group, start)
+
+        if event.link.is_receiver:
+            # A client sending to the broker
+
+            if event.link.remote_target.dynamic:
+                # A temporary queue
+                address = "{0}/{1}".format(event.connection.remote_container, event.link.name)
+                node = self.broker._create_queue(address)
+                node.owner = event.link
+            elif event.link.remote_target.address in (None, ""):
+                # Anonymous relay - no queueing
+                address = None
+                node = None
+            elif _is_pattern(event.link.remote_target.address):
+                # The link is closed once it is open
+                event.link.condition = _proton.Condition("amqp:not-allowed",
+                                                         "Cannot send to a wildcard address")
+                return
+            else:
+                # A named queue or topic, or wildcard subscriptions
+                address = event.link.remote_target.address
+                node = self.broker._route(address)[0]
+
+            event.link.target.address = address
+
+            self.broker._add_producer(event.link)
+
+            if node is None:
+                self.broker._grant_credit(event.link)
+            elif not node.blocked:
+                self.broker._grant_credit(event.link, node)
+
+    def on_link_opened(self, event):
+        if event.link.condition is not None:
+            event.link.close()
+
+    def on_link_closing(self, event):
+        if event.link.is_sender:
+            self.broker._remove_consumer(event.link)
+        else:
+            self.broker._remove_producer(event.link)
+
+    def on_connection_opening(self, event):
+        # XXX I think this should happen automatically
+        event.connection.container = event.container.container_id
+
+    def on_connection_opened(self, event):
+        self.broker.notice("Opened connection from {0}", _container_repr(event.connection))
+
+    def on_connection_closing(self, event):
+        self.broker._remove_links(event.connection)
+
+    def on_connection_closed(self, event):
+        self.broker.notice("Closed connection from {0}", _container_repr(event.connection))
+
+    def on_disconnected(self, event):
+        self.broker.notice("Disconnected from {0}", _container_repr(event.connection))
+
+        self.broker._remove_links(event.connection)
+
+    def on_link_flow(self, event):
+        if event.link.is_sender:
+            if event.link.drain_mode:
+                event.link.drained()
+
+            node = self.broker._nodes.get(event.link.source.address)
+
+            if node is not None:
+                node.update_credit(event.link)
+
+    def on_sendable(self, event):
+        if event.link.source.address == "$metrics":
+            while event.link.credit > 0:
+                event.link.send(_proton.Message(address="$metrics", body=self.broker.get_metrics()))
+
+            return
+
+        node = self.broker._nodes.get(event.link.source.address)
+
+        if node is not None:
+            self.broker._dirty_nodes.add(node)
+
+    def on_settled(self, event):
+        template = "Client '{0}' {1} {2} for {3}"
+        client = event.connection.remote_container
+        source = _terminus_repr(event.link.source)
+        delivery = event.delivery
+
+        unsettled = self.broker._unsettled.get(event.link)
+        message = None
+
+        if unsettled is not None:
+            message = unsettled.pop(delivery, None)
+
+        node = self.broker._nodes.get(event.link.source.address)
+        tracked = message is not None and node is not None
+
+        if tracked:
+            node.settled([message])
+
+        if tracked and delivery.remote_state in (delivery.RELEASED, delivery.MODIFIED):
+            failed = delivery.remote_state == delivery.MODIFIED and delivery.remote.failed
+            node.requeue([message], failed)
+        elif tracked and delivery.remote_state == delivery.REJECTED:
+            self.broker.metrics["rejected_messages"] += 1
+            self.broker._dead_letter(node, message, "rejected")
+        else:
+            journal_id = getattr(delivery, "journal_id", None)
+
+            if journal_id is not None:
+                self.broker._journal.acknowledge(journal_id)
+
+        if delivery.remote_state == delivery.ACCEPTED:
+            self.broker.info(template, client, "accepted", _delivery_repr(delivery), source)
+        elif delivery.remote_state == delivery.REJECTED:
+            self.broker.warn(template, client, "rejected", _delivery_repr(delivery), source)
+        elif delivery.remote_state == delivery.RELEASED:
+            self.broker.notice(template, client, "released", _delivery_repr(delivery), source)
+        elif delivery.remote_state == delivery.MODIFIED:
+            self.broker.notice(template, client, "modified", _delivery_repr(delivery), source)
+
+    def on_delivery(self, event):
+        # In pass-through mode, take the encoded message before the
+        # incoming message handler decodes it
+        if not self.broker.passthrough:
+            return
+
+        delivery = event.delivery
+        link = event.link
+
+        if not link.is_receiver or not delivery.readable or delivery.partial or delivery.aborted:
+            return
+
+        message = _Message(data=link.recv(delivery.pending))
+        link.advance()
+
+        self.route_message(link, delivery, message)
+
+    def on_message(self, event):
+        self.route_message(event.link, event.delivery, _Message(message=event.message))
+
+    def route_message(self, link, delivery, message):
+        address = link.target.address
+
+        if address in (None, ""):
+            address = message.address
+
+        if address is None:
+            self.broker.warn("Rejected a message with no address from {0}", _container_repr(link.connection))
+            self.reject(delivery)
+            self.broker._grant_credit(link)
+            return
+
+        # A wildcard address names subscriptions, not a destination
+        if _is_pattern(address):
+            self.broker.warn("Rejected a message to wildcard address '{0}' from {1}", address,
+                             _container_repr(link.connection))
+            self.reject(delivery)
+            self.broker._grant_credit(link)
+            return
+
+        node, subscriptions = self.broker._route(address)
+        journal = self.broker._journal
+
+        if node is not None and journal is not None and message.durable:
+            message.journal_id = journal.enqueue(address, message)
+            journal.accept_when_synced(delivery)
+        else:
+            self.accept(delivery)
+
+        # A scheduled message is routed again when it is due
+        if not self.broker._delay_store.add(address, message):
+            self.broker._store_message(delivery, message, node, subscriptions)
+
+        # Anonymous relay producers are never blocked, since they are
+        # not tied to one queue, and neither are producers to addresses
+        # that only subscriptions match
+        if link.target.address is None or node is None:
+            self.broker._grant_credit(link)
+        elif not node.blocked:
+            self.broker._grant_credit(link, node)
+
+    def on_reactor_quiesced(self, event):
+        # Sending here produces new events, so the reactor processes
+        # them before it next waits for I/O
+        self.broker._dispatch()
+
+        if self.broker._journal is not None and self.broker.fsync == "tick":
+            self.broker._journal.sync()
+
+    def on_unhandled(self, name, event):
+        self.broker.debug("Unhandled event: {0} {1}", name, event)
+
+class _FrontDoor(_handlers.MessagingHandler):
+    # In multi-process mode, the front door accepts client connections.
+    # A client that offers the redirect capability is sent on to the
+    # worker that owns the address of its first link, and its messages
+    # never pass through the front door.
+    #
+    # Other clients have each link relayed to a peer link on the worker
+    # that owns the link's address.  A wildcard subscription is relayed
+    # from a peer link on every worker, each of which matches the
+    # addresses that worker owns.  Messages pass through as encoded
+    # bytes, credit flows from the consuming side to the producing
+    # side, and dispositions flow back.
+
+    def __init__(self, broker):
+        super(_FrontDoor, self).__init__(prefetch=0, auto_accept=False, auto_settle=False)
+
+        self.broker = broker
+
+        # Credit for clients sending to the anonymous relay
+        self.anonymous_window = 100
+
+        self.worker_connections = dict()
+        self.anonymous_senders = dict()
+
+    def on_start(self, event):
+        for url in self.broker._worker_urls:
+            connection = event.container.connect(url)
+            connection.worker = True
+
+            self.worker_connections[url] = connection
+            self.anonymous_senders[url] = event.container.create_sender(connection, None)
+
+        self.acceptor = self.broker._listen(event.container)
+        self.broker._write_ready_file()
+
+    def on_connection_opening(self, event):
+        event.connection.container = event.container.container_id
+
+    def on_connection_opened(self, event):
+        if not getattr(event.connection, "worker", False):
+            self.broker.notice("Opened connection from {0}", _container_repr(event.connection))
+
+    def on_link_opening(self, event):
+        link = event.link
+        peers = list()
+
+        if self.redirect(event.connection, link):
+            return
+
+        if link.is_sender:
+            # A client receiving from the broker
+
+            if link.remote_source.dynamic:
+                # A temporary queue, created on the owning worker as a
+                # named queue
+                address = "{0}/{1}".format(event.connection.remote_container, link.name)
+            elif link.remote_source.address in (None, ""):
+                raise Exception("The client created a receiver with no source address")
+            else:
+                address = link.remote_source.address
+
+            link.source.address = address
+
+            if _is_pattern(address):
+                urls = self.broker._worker_urls
+            else:
+                urls = [self.broker._worker_url(address)]
+
+            name = None
+            options = list()
+
+            # The worker checks the selector and start position and
+            # rejects them if they are invalid
+            filters = _get_filters(link.remote_source)
+
+            if filters:
+                link.source.filter.put_dict(filters)
+                options.append(_reactor.Filter(filters))
+
+            # The worker keys durable subscriptions by link name, so the
+            # peer link name includes the client's
+            if link.remote_source.durability != _proton.Terminus.NONDURABLE:
+                name = _link_key(link)
+                options.append(_reactor.DurableSubscription())
+
+            link.snd_settle_mode = link.remote_snd_settle_mode
+
+            if link.snd_settle_mode == _proton.Link.SND_SETTLED:
+                options.append(_reactor.AtMostOnce())
+
+            for url in urls:
+                peers.append(event.container.create_receiver(self.worker_connections[url], address,
+                                                             name=name, options=options))
+
+        if link.is_receiver:
+            # A client sending to the broker
+
+            address = link.remote_target.address
+
+            if address in (None, ""):
+                # Anonymous relay - messages are routed one by one
+                address = None
+                link.flow(self.anonymous_window)
+            else:
+                connection = self.worker_connections[self.broker._worker_url(address)]
+                peers.append(event.container.create_sender(connection, address))
+
+            link.target.address = address
+
+        link.peers = peers
+
+        for peer in peers:
+            peer.peers = [link]
+
+        self.broker.info("Relaying {0} link for {1} from {2}", "outgoing" if link.is_sender else "incoming",
+                         "'{0}'".format(address) if address else "the anonymous relay",
+                         _container_repr(event.connection))
+
+    def redirect(self, connection, link):
+        # The workers have no TLS configuration, so TLS clients are
+        # always relayed
+        if self.broker.cert is not None:
+            return False
+
+        if _REDIRECT_CAPABILITY not in (connection.remote_offered_capabilities or ()):
+            return False
+
+        if link.is_sender:
+            terminus = link.remote_source
+        else:
+            terminus = link.remote_target
+
+        address = terminus.address
+
+        # Dynamic queues, the anonymous relay, and wildcard
+        # subscriptions are not tied to one worker
+        if terminus.dynamic or address in (None, "") or _is_pattern(address):
+            return False
+
+        index = self.broker._worker_index(address)
+        host = connection.remote_hostname or self.broker._worker_host
+        port = self.broker._worker_ports[index]
+
+        info = {_proton.symbol("network-host"): host, _proton.symbol("port"): _proton.ushort(port)}
+
+        # The link is refused with a null terminus, so the client does
+        # not take it as open before the connection closes
+        if link.is_sender:
+            link.source.type = _proton.Terminus.UNSPECIFIED
+        else:
+            link.target.type = _proton.Terminus.UNSPECIFIED
+
+        connection.condition = _proton.Condition("amqp:connection:redirect",
+                                                 "Address '{0}' is on another server".format(address), info)
+        connection.close()
+
+        self.broker.info("Redirected {0} to worker {1} for '{2}'", _container_repr(connection), index, address)
+
+        return True
+
+    def on_link_opened(self, event):
+        if event.link.condition is not None:
+            event.link.close()
+
+    def on_link_flow(self, event):
+        link = event.link
+        peers = getattr(link, "peers", None)
+
+        if not link.is_sender or not peers:
+            return
+
+        if link.drain_mode:
+            link.drained()
+
+        # Keep the receiving side's credit equal to the sending side's.
+        # With several peers, as for a wildcard subscription, the extra
+        # deliveries wait in the front door until the client has credit
+        # for them.
+        for peer in peers:
+            delta = link.credit - peer.credit
+
+            if delta > 0:
+                peer.flow(delta)
+
+    def on_delivery(self, event):
+        delivery = event.delivery
+        link = event.link
+
+        if link.is_receiver:
+            if delivery.readable and not delivery.partial and not delivery.aborted:
+                data = link.recv(delivery.pending)
+                link.advance()
+
+                self.relay(link, delivery, data)
+        elif delivery.updated:
+            peer = getattr(delivery, "peer", None)
+
+            if peer is not None:
+                peer.update(delivery.remote_state)
+
+            if delivery.settled:
+                delivery.settle()
+
+                if peer is not None:
+                    peer.settle()
+
+    def relay(self, link, delivery, data):
+        peers = getattr(link, "peers", None)
+
+        if peers:
+            sender = peers[0]
+        else:
+            address = _Message(data=data).address
+
+            if address is None:
+                self.broker.warn("Rejected a message with no address from {0}", _container_repr(link.connection))
+                self.reject(delivery)
+                link.flow(1)
+                return
+
+            sender = self.anonymous_senders[self.broker._worker_url(address)]
+            link.flow(1)
+
+        outgoing = sender.delivery(sender.delivery_tag())
+
+        sender.stream(data)
+        sender.advance()
+
+        if delivery.settled:
+            outgoing.settle()
+            delivery.settle()
+        else:
+            outgoing.peer = delivery
+
+    def on_link_closing(self, event):
+        self.close_relay(event.link)
+
+    def on_link_error(self, event):
+        # Pass errors from the worker, such as a bad selector, on to the
+        # client instead of closing the connection
+        for peer in getattr(event.link, "peers", ()):
+            peer.condition = event.link.remote_condition
+
+        self.close_relay(event.link)
+
+    def close_relay(self, link):
+        # Close the client link and all the worker links for it
+        peers = getattr(link, "peers", None)
+
+        if not peers:
+            return
+
+        if getattr(link.connection, "worker", False):
+            link = peers[0]
+
+        for x in [link] + link.peers:
+            if not x.state & _proton.Endpoint.LOCAL_CLOSED:
+                x.close()
+
+    def on_connection_closing(self, event):
+        self.close_peers(event.connection)
+
+    def on_disconnected(self, event):
+        if getattr(event.connection, "worker", False):
+            self.broker.fail("Lost the connection to a worker")
+
+        self.close_peers(event.connection)
+
+    def close_peers(self, connection):
+        link = connection.link_head(0)
+
+        while link is not None:
+            for peer in getattr(link, "peers", ()):
+                if not peer.state & _proton.Endpoint.LOCAL_CLOSED:
+                    peer.close()
+
+            link = link.next(0)
+
+    def on_unhandled(self, name, event):
+        self.broker.debug("Unhandled event: {0} {1}", name, event)
+
+_SELECTOR_DESCRIPTORS = ("apache.org:selector-filter:string", 0x0000468c00000004)
+
+_START_FILTER = _proton.symbol("qtools:start")
+
+# Offered by clients whose connections have links for one address only,
+# which the front door may then redirect to the worker that owns it
+_REDIRECT_CAPABILITY = _proton.symbol("qtools:redirect")
+
+_SELECTOR_TOKEN = _re.compile(r"""\s*(?:
+    (?P<string>'(?:[^']|'')*')
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+  | (?P<operator><>|<=|>=|[=<>+\-*/(),])
+  | (?P<word>[A-Za-z_$][\w$.]*)
+  )""", _re.VERBOSE)
+
+_SELECTOR_KEYWORDS = {"AND", "OR", "NOT", "BETWEEN", "LIKE", "ESCAPE", "IN", "IS", "NULL", "TRUE", "FALSE"}
+
+# Header and properties fields available to selectors.  Other names
+# are application properties.
+_SELECTOR_FIELDS = {
+    "JMSMessageID": lambda message: message.id,
+    "JMSCorrelationID": lambda message: message.correlation_id,
+    "JMSPriority": lambda message: message.priority,
+    "JMSType": lambda message: message.subject,
+}
+
+_COMPARISONS = {
+    "=": lambda x, y: x == y,
+    "<>": lambda x, y: x != y,
+    "<": lambda x, y: x < y,
+    ">": lambda x, y: x > y,
+    "<=": lambda x, y: x <= y,
+    ">=": lambda x, y: x >= y,
+}
+
+_ARITHMETIC = {
+    "+": lambda x, y: x + y,
+    "-": lambda x, y: x - y,
+    "*": lambda x, y: x * y,
+    "/": lambda x, y: x / y,
+}
+
+class _Selector:
+    # A JMS-style message selector.  The expression is parsed once into
+    # a tree of closures, so matching a message is just a call.  None
+    # stands for the unknown value of SQL's three-valued logic.
+
+    def __init__(self, text):
+        self.text = text
+
+        self._tokens = list()
+        self._pos = 0
+
+        pos = 0
+
+        while pos < len(text):
+            match = _SELECTOR_TOKEN.match(text, pos)
+
+            if match is None or match.end() == pos:
+                if text[pos:].strip() == "":
+                    break
+
+                raise ValueError("Unexpected input at '{0}'".format(text[pos:]))
+
+            kind = match.lastgroup
+            value = match.group(kind)
+
+            if kind == "word" and value.upper() in _SELECTOR_KEYWORDS:
+                kind, value = "keyword", value.upper()
+
+            self._tokens.append((kind, value))
+            pos = match.end()
+
+        expression = self._parse_or()
+
+        if self._pos != len(self._tokens):
+            raise ValueError("Unexpected '{0}'".format(self._tokens[self._pos][1]))
+
+        self._expression = expression
+
+    def __repr__(self):
+        return "selector '{0}'".format(self.text)
+
+    def match(self, message):
+        return self._expression(message) is True
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+
+        if token[0] is None:
+            raise ValueError("Unexpected end of selector")
+
+        self._pos += 1
+
+        return token
+
+    def _accept(self, value):
+        kind, token = self._peek()
+
+        if kind in ("keyword", "operator") and token == value:
+            self._pos += 1
+            return True
+
+        return False
+
+    def _expect(self, value):
+        if not self._accept(value):
+            raise ValueError("Expected '{0}'".format(value))
+
+    def _parse_or(self):
+        left = self._parse_and()
+
+        while self._accept("OR"):
+            left = _selector_or(left, self._parse_and())
+
+        return left
+
+    def _parse_and(self):
+        left = self._parse_not()
+
+        while self._accept("AND"):
+            left = _selector_and(left, self._parse_not())
+
+        return left
+
+    def _parse_not(self):
+        if self._accept("NOT"):
+            return _selector_not(self._parse_not())
+
+        return self._parse_comparison()
+
+    def _parse_comparison(self):
+        left = self._parse_additive()
+        kind, token = self._peek()
+
+        if kind == "operator" and token in _COMPARISONS:
+            self._pos += 1
+            return _selector_compare(_COMPARISONS[token], left, self._parse_additive())
+
+        if self._accept("IS"):
+            negated = self._accept("NOT")
+            self._expect("NULL")
+
+            return lambda message: (left(message) is None) != negated
+
+        negated = self._accept("NOT")
+
+        if self._accept("BETWEEN"):
+            low = self._parse_additive()
+            self._expect("AND")
+            high = self._parse_additive()
+
+            result = _selector_and(_selector_compare(_COMPARISONS[">="], left, low),
+                                   _selector_compare(_COMPARISONS["<="], left, high))
+        elif self._accept("LIKE"):
+            pattern = self._parse_string()
+            escape = None
+
+            if self._accept("ESCAPE"):
+                escape = self._parse_string()
+
+            result = _selector_like(left, pattern, escape)
+        elif self._accept("IN"):
+            self._expect("(")
+            values = {self._parse_string()}
+
+            while self._accept(","):
+                values.add(self._parse_string())
+
+            self._expect(")")
+
+            result = _selector_in(left, frozenset(values))
+        elif negated:
+            raise ValueError("Expected BETWEEN, LIKE, or IN after NOT")
+        else:
+            return left
+
+        if negated:
+            return _selector_not(result)
+
+        return result
+
+    def _parse_additive(self):
+        left = self._parse_multiplicative()
+
+        while True:
+            kind, token = self._peek()
+
+            if kind != "operator" or token not in ("+", "-"):
+                return left
+
+            self._pos += 1
+            left = _selector_arithmetic(_ARITHMETIC[token], left, self._parse_multiplicative())
+
+    def _parse_multiplicative(self):
+        left = self._parse_unary()
+
+        while True:
+            kind, token = self._peek()
+
+            if kind != "operator" or token not in ("*", "/"):
+                return left
+
+            self._pos += 1
+            left = _selector_arithmetic(_ARITHMETIC[token], left, self._parse_unary())
+
+    def _parse_unary(self):
+        if self._accept("-"):
+            operand = self._parse_unary()
+            return _selector_arithmetic(_ARITHMETIC["-"], lambda message: 0, operand)
+
+        if self._accept("+"):
+            return self._parse_unary()
+
+        return self._parse_primary()
+
+    def _parse_primary(self):
+        if self._accept("("):
+            expression = self._parse_or()
+            self._expect(")")
+
+            return expression
+
+        kind, token = self._next()
+
+        if kind == "string":
+            value = token[1:-1].replace("''", "'")
+            return lambda message: value
+
+        if kind == "number":
+            value = float(token) if any(x in token for x in ".eE") else int(token)
+            return lambda message: value
+
+        if kind == "keyword" and token in ("TRUE", "FALSE"):
+            value = token == "TRUE"
+            return lambda message: value
+
+        if kind == "word":
+            try:
+                return _SELECTOR_FIELDS[token]
+            except KeyError:
+                return lambda message: message.properties.get(token)
+
+        raise ValueError("Unexpected '{0}'".format(token))
+
+    def _parse_string(self):
+        kind, token = self._next()
+
+        if kind != "string":
+            raise ValueError("Expected a string literal")
+
+        return token[1:-1].replace("''", "'")
+
+def _selector_or(left, right):
+    def evaluate(message):
+        x = left(message)
+
+        if x is True:
+            return True
+
+        y = right(message)
+
+        if y is True:
+            return True
+
+        if x is None or y is None:
+            return None
+
+        return False
+
+    return evaluate
+
+def _selector_and(left, right):
+    def evaluate(message):
+        x = left(message)
+
+        if x is False:
+            return False
+
+        y = right(message)
+
+        if y is False:
+            return False
+
+        if x is None or y is None:
+            return None
+
+        return True
+
+    return evaluate
+
+def _selector_not(operand):
+    def evaluate(message):
+        x = operand(message)
+
+        if x is None:
+            return None
+
+        return not x
+
+    return evaluate
+
+def _selector_compare(function, left, right):
+    def evaluate(message):
+        x = left(message)
+        y = right(message)
+
+        if x is None or y is None:
+            return None
+
+        try:
+            return function(x, y)
+        except TypeError:
+            # Comparing a string and a number
+            return None
+
+    return evaluate
+
+def _selector_arithmetic(function, left, right):
+    def evaluate(message):
+        x = left(message)
+        y = right(message)
+
+        if x is None or y is None:
+            return None
+
+        try:
+            return function(x, y)
+        except (TypeError, ZeroDivisionError):
+            return None
+
+    return evaluate
+
+def _selector_like(operand, pattern, escape):
+    regex = list()
+    chars = iter(pattern)
+
+    for char in chars:
+        if char == escape:
+            regex.append(_re.escape(next(chars, "")))
+        elif char == "%":
+            regex.append(".*")
+        elif char == "_":
+            regex.append(".")
+        else:
+            regex.append(_re.escape(char))
+
+    regex = _re.compile("".join(regex), _re.DOTALL)
+
+    def evaluate(message):
+        x = operand(message)
+
+        if not isinstance(x, str):
+            return None
+
+        return regex.fullmatch(x) is not None
+
+    return evaluate
+
+def _selector_in(operand, values):
+    def evaluate(message):
+        x = operand(message)
+
+        if not isinstance(x, str):
+            return None
+
+        return x in values
+
+    return evaluate
+
+class _Message:
+    # A stored message.  In pass-through mode it holds only the encoded
+    # bytes, and the header fields the broker needs are read from them
+    # without decoding the message.
+
+    __slots__ = ("data", "message", "journal_id", "expiry", "expired", "taken", "offset", "appended")
+
+    def __init__(self, data=None, message=None):
+        assert data is not None or message is not None
+
+        self.data = data
+        self.message = message
+        self.journal_id = None
+        self.expiry = None
+        self.expired = False
+        self.taken = False
+        self.offset = None
+        self.appended = None
+
+    def __repr__(self):
+        if self.message is not None:
+            return repr(self.message)
+
+        return "message ({0} bytes)".format(len(self.data))
+
+    @property
+    def address(self):
+        if self.message is not None:
+            return self.message.address
+
+        return _peek_properties(self.data)[2]
+
+    @property
+    def durable(self):
+        if self.message is not None:
+            return self.message.durable
+
+        return bool(_peek_header(self.data)[0])
+
+    @property
+    def id(self):
+        if self.message is not None:
+            return self.message.id
+
+        return _peek_properties(self.data)[0]
+
+    @property
+    def subject(self):
+        if self.message is not None:
+            return self.message.subject
+
+        return _peek_properties(self.data)[3]
+
+    @property
+    def correlation_id(self):
+        if self.message is not None:
+            return self.message.correlation_id
+
+        return _peek_properties(self.data)[5]
+
+    @property
+    def group_id(self):
+        if self.message is not None:
+            return self.message.group_id
+
+        return _peek_properties(self.data)[10]
+
+    @property
+    def properties(self):
+        if self.message is not None:
+            return self.message.properties or {}
+
+        return _peek_application_properties(self.data)
+
+    @property
+    def priority(self):
+        if self.message is not None:
+            return self.message.priority
+
+        priority = _peek_header(self.data)[1]
+
+        # The AMQP default
+        if priority is None:
+            return 4
+
+        return priority
+
+    @property
+    def delivery_count(self):
+        if self.message is not None:
+            return self.message.delivery_count
+
+        return _peek_header(self.data)[4] or 0
+
+    def add_failed_delivery(self):
+        # Count the failure in the message header.  A message held only
+        # as bytes is decoded so it can be changed.
+        if self.message is None:
+            self.message = _proton.Message()
+            self.message.decode(self.data)
+
+        self.message.delivery_count += 1
+        self.data = None
+
+    def get_delivery_time(self):
+        # The time the message is due, in seconds since the epoch, or
+        # None to deliver it now.  A delay counts from the time of the
+        # call.  The journal records the result, so recovery uses that
+        # instead.
+        if self.message is not None:
+            annotations = self.message.annotations or {}
+        else:
+            annotations = _peek_message_annotations(self.data)
+
+        time = annotations.get("x-opt-delivery-time")
+
+        if isinstance(time, (int, float)):
+            return time / 1000
+
+        delay = annotations.get("x-opt-delivery-delay")
+
+        if isinstance(delay, (int, float)):
+            return _time.time() + delay / 1000
+
+        return None
+
+    def get_expiry(self):
+        # The earlier of the TTL from now and the absolute expiry time,
+        # in seconds since the epoch
+        if self.message is not None:
+            ttl = self.message.ttl or None
+            absolute = self.message.expiry_time or None
+        else:
+            ttl = _peek_header(self.data)[2]
+            absolute = _peek_properties(self.data)[8]
+
+            if ttl is not None:
+                ttl = ttl / 1000
+
+            if absolute is not None:
+                absolute = absolute / 1000
+
+        if ttl is not None:
+            ttl = _time.time() + ttl
+
+            if absolute is None or ttl < absolute:
+                return ttl
+
+        return absolute
+
+    def encode(self):
+        if self.data is not None:
+            return self.data
+
+        return self.message.encode()
+
+    def encode_once(self):
+        # Keep the encoded bytes.  Sending then streams them instead of
+        # encoding the message again.
+        if self.data is None:
+            self.data = self.message.encode()
+
+    def send(self, sender, tag=None):
+        # The same protocol as proton.Message.send, so links can send
+        # stored messages directly
+        if self.data is None:
+            return self.message.send(sender, tag=tag)
+
+        delivery = sender.delivery(tag or sender.delivery_tag())
+
+        sender.stream(self.data)
+        sender.advance()
+
+        if sender.snd_settle_mode == _proton.Link.SND_SETTLED:
+            delivery.settle()
+
+        return delivery
+
+# Just enough of the AMQP type system to read the fields of the
+# header and properties sections from an encoded message
+
+_HEADER_SECTION = 0x70
+_PROPERTIES_SECTION = 0x73
+_MESSAGE_ANNOTATIONS_SECTION = 0x72
+_APPLICATION_PROPERTIES_SECTION = 0x74
+
+_HEADER_FIELD_COUNT = 5
+_PROPERTIES_FIELD_COUNT = 13
+
+_FIXED_WIDTHS = {0x4: 0, 0x5: 1, 0x6: 2, 0x7: 4, 0x8: 8, 0x9: 16}
+
+_SCALAR_FORMATS = {
+    0x50: ">B", 0x51: ">b", 0x52: ">B", 0x53: ">B", 0x54: ">b", 0x55: ">b", 0x56: ">?",
+    0x60: ">H", 0x61: ">h",
+    0x70: ">I", 0x71: ">i", 0x72: ">f",
+    0x80: ">Q", 0x81: ">q", 0x82: ">d", 0x83: ">q",
+}
+
+_CONSTANTS = {0x40: None, 0x41: True, 0x42: False, 0x43: 0, 0x44: 0}
+
+def _skip_value(data, pos):
+    code = data[pos]
+    pos += 1
+
+    if code == 0x00:
+        pos = _skip_value(data, pos)
+        return _skip_value(data, pos)
+
+    category = code >> 4
+
+    try:
+        return pos + _FIXED_WIDTHS[category]
+    except KeyError:
+        pass
+
+    if category in (0xa, 0xc, 0xe):
+        return pos + 1 + data[pos]
+
+    if category in (0xb, 0xd, 0xf):
+        return pos + 4 + _struct.unpack_from(">I", data, pos)[0]
+
+    raise ValueError("Unknown AMQP type code 0x{0:02x}".format(code))
+
+def _read_value(data, pos):
+    # Returns the value at pos, or None if it is not a simple type
+    code = data[pos]
+
+    try:
+        return _CONSTANTS[code]
+    except KeyError:
+        pass
+
+    try:
+        return _struct.unpack_from(_SCALAR_FORMATS[code], data, pos + 1)[0]
+    except KeyError:
+        pass
+
+    if code in (0xa0, 0xa1, 0xa3):
+        start, end = pos + 2, pos + 2 + data[pos + 1]
+    elif code in (0xb0, 0xb1, 0xb3):
+        start = pos + 5
+        end = start + _struct.unpack_from(">I", data, pos + 1)[0]
+    else:
+        return None
+
+    value = bytes(data[start:end])
+
+    if code != 0xa0 and code != 0xb0:
+        value = value.decode()
+
+    return value
+
+def _read_list(data, pos, length):
+    fields = [None] * length
+    code = data[pos]
+
+    if code == 0x45:
+        return fields
+
+    if code == 0xc0:
+        count = data[pos + 2]
+        pos += 3
+    elif code == 0xd0:
+        count = _struct.unpack_from(">I", data, pos + 5)[0]
+        pos += 9
+    else:
+        raise ValueError("Expected an AMQP list")
+
+    for i in range(min(count, length)):
+        fields[i] = _read_value(data, pos)
+        pos = _skip_value(data, pos)
+
+    return fields
+
+def _read_map(data, pos):
+    # Values that are not simple types come back as None
+    code = data[pos]
+
+    if code == 0xc1:
+        count = data[pos + 2]
+        pos += 3
+    elif code == 0xd1:
+        count = _struct.unpack_from(">I", data, pos + 5)[0]
+        pos += 9
+    else:
+        raise ValueError("Expected an AMQP map")
+
+    entries = dict()
+
+    for i in range(count // 2):
+        key = _read_value(data, pos)
+        pos = _skip_value(data, pos)
+
+        entries[key] = _read_value(data, pos)
+        pos = _skip_value(data, pos)
+
+    return entries
+
+def _find_section(data, descriptor):
+    pos = 0
+
+    while pos < len(data):
+        if data[pos] != 0x00 or data[pos + 1] != 0x53:
+            break
+
+        code = data[pos + 2]
+
+        if code == descriptor:
+            return pos + 3
+
+        if code > descriptor:
+            break
+
+        pos = _skip_value(data, pos + 3)
+
+def _peek_header(data):
+    pos = _find_section(data, _HEADER_SECTION)
+
+    if pos is None:
+        return [None] * _HEADER_FIELD_COUNT
+
+    return _read_list(data, pos, _HEADER_FIELD_COUNT)
+
+def _peek_properties(data):
+    pos = _find_section(data, _PROPERTIES_SECTION)
+
+    if pos is None:
+        return [None] * _PROPERTIES_FIELD_COUNT
+
+    return _read_list(data, pos, _PROPERTIES_FIELD_COUNT)
+
+def _peek_message_annotations(data):
+    pos = _find_section(data, _MESSAGE_ANNOTATIONS_SECTION)
+
+    if pos is None:
+        return {}
+
+    return _read_map(data, pos)
+
+def _peek_application_properties(data):
+    pos = _find_section(data, _APPLICATION_PROPERTIES_SECTION)
+
+    if pos is None:
+        return {}
+
+    return _read_map(data, pos)
+
+def _find_selector(terminus):
+    # Returns the selector entry of the terminus filter set as a
+    # one-item dict, or None if there is no selector
+    for name, value in _get_filters(terminus).items():
+        if isinstance(value, _proton.Described) and value.descriptor in _SELECTOR_DESCRIPTORS:
+            return {name: value}
+
+def _get_selector(link):
+    filters = _find_selector(link.remote_source)
+
+    if filters is None:
+        return None
+
+    selector = _Selector(list(filters.values())[0].value)
+
+    # Tell the client the filter is in force
+    _echo_filters(link, filters)
+
+    return selector
+
+def _get_start(link):
+    # Returns None, "now", or a time in seconds since the epoch.  The
+    # filter value is "earliest", "now", or an AMQP timestamp.
+    filters = _get_filters(link.remote_source)
+
+    try:
+        value = filters[_START_FILTER]
+    except KeyError:
+        return None
+
+    if isinstance(value, _proton.timestamp):
+        start = value / 1000
+    elif value == "earliest":
+        start = None
+    elif value == "now":
+        start = "now"
+    else:
+        raise ValueError("Unknown start position '{0}'".format(value))
+
+    _echo_filters(link, {_START_FILTER: value})
+
+    return start
+
+def _get_filters(terminus):
+    # Returns the terminus filter set as a dict
+    filters = terminus.filter
+    filters.rewind()
+
+    if filters.next() != _proton.Data.MAP:
+        return {}
+
+    return filters.get_object()
+
+def _echo_filters(link, filters):
+    # Add to the filters the broker tells the client are in force
+    echoed = _get_filters(link.source)
+    echoed.update(filters)
+
+    link.source.filter.clear()
+    link.source.filter.put_dict(echoed)
+
+def _log_stored(broker, delivery, message, node):
+    # Recovered and dead-lettered messages have no incoming delivery
+    if delivery is None:
+        broker.info("Stored {0} on {1}", message, node)
+    else:
+        broker.notice("Stored {0} from {1} on {2}", message, _container_repr(delivery.connection), node)
+
+def _is_pattern(address):
+    return any(x in ("*", "#") for x in address.split("."))
+
+def _link_key(link):
+    return "{0}/{1}".format(link.connection.remote_container, link.name)
+
+def _container_repr(connection):
+    return "client '{0}'".format(connection.remote_container)
+
+def _terminus_repr(terminus):
+    return "terminus '{0}'".format(terminus.address)
+
+def _delivery_repr(delivery):
+    return "delivery '{0}'".format(delivery.tag)
+
+def _get_free_port():
+    with _socket.socket(_socket.AF_INET, _socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def await_broker(ready_file, timeout=30):
+    start_time = _time.time()
+    interval = 0.125
+
+    while True:
+        if _time.time() - start_time > timeout:
+            raise Exception("Timed out waiting for the broker")
+
+        _time.sleep(interval)
+
+        with open(ready_file, "r") as f:
             if f.read() == "ready\n":
                 break
 
@@ -499,7 +3983,46 @@ def main():
                         help="The file containing trusted client certificates.  "
                         "If set, the server verifies client certificates.")
     parser.add_argument("--topic", metavar="ADDRESS", action="append",
-                        help="Configure multicast distribution for ADDRESS")
+                        help="Configure multicast distribution for ADDRESS.  "
+                        "Receivers from ADDRESS::GROUP share one copy of the messages.")
+    parser.add_argument("--retention", metavar=("ADDRESS", "POLICY"), nargs=2, action="append",
+                        help="Limit the messages kept for topic ADDRESS.  "
+                        "POLICY is a comma-separated list of count:N, bytes:N, age:SECONDS, and slowest.")
+    parser.add_argument("--priority-queue", metavar="ADDRESS", action="append",
+                        help="Deliver messages on queue ADDRESS in order of priority")
+    parser.add_argument("--last-value-queue", metavar=("ADDRESS", "KEY"), nargs=2, action="append",
+                        help="Keep only the latest message for each value of property KEY on queue ADDRESS")
+    parser.add_argument("--partitioned-queue", metavar=("ADDRESS", "KEY", "COUNT"), nargs=3, action="append",
+                        help="Split queue ADDRESS into COUNT partitions by the hash of property KEY, "
+                        "or of the group ID if there is no KEY, and give each partition to one consumer")
+    parser.add_argument("--watermarks", metavar=("ADDRESS", "HIGH", "LOW"), nargs=3, action="append",
+                        help="Stop granting credit to producers on queue ADDRESS when it holds HIGH messages, "
+                        "and resume when it drains to LOW")
+    parser.add_argument("--dead-letter", metavar=("ADDRESS", "DEAD_LETTER_ADDRESS"), nargs=2, action="append",
+                        help="Move messages rejected by consumers of queue ADDRESS, or over the delivery limit, "
+                        "to DEAD_LETTER_ADDRESS")
+    parser.add_argument("--max-deliveries", metavar="COUNT", type=int,
+                        help="Take a queue message off the queue after COUNT failed deliveries (default no limit). "
+                        "A consumer that detaches fails only its oldest unsettled delivery")
+    parser.add_argument("--journal", metavar="DIR",
+                        help="Keep durable messages in a journal in DIR and recover them on restart")
+    parser.add_argument("--fsync", metavar="POLICY", default="tick",
+                        help="When to sync the journal to disk: always, tick (once per reactor pass), never, "
+                        "or an interval in milliseconds (default tick)")
+    parser.add_argument("--checkpoint-interval", metavar="SECONDS", default=60, type=float,
+                        help="Write a journal checkpoint every SECONDS (default 60)")
+    parser.add_argument("--idle-timeout", metavar="SECONDS", default=60, type=float,
+                        help="Delete queues created on first use after SECONDS with no messages, consumers, "
+                        "or producers (default 60, 0 to disable)")
+    parser.add_argument("--workers", metavar="COUNT", default=1, type=int,
+                        help="Run COUNT broker processes, each owning a share of the addresses (default 1). "
+                        "Clients that offer the qtools:redirect capability are redirected to the owning process.")
+    parser.add_argument("--spill-after", metavar="COUNT", type=int,
+                        help="Page queued messages beyond COUNT per queue out to disk")
+    parser.add_argument("--spill-dir", metavar="DIR",
+                        help="Write spilled messages to DIR (default is a temporary directory)")
+    parser.add_argument("--passthrough", action="store_true",
+                        help="Forward messages without decoding them")
     parser.add_argument("--quiet", action="store_true",
                         help="Print no logging to the console")
     parser.add_argument("--verbose", action="store_true",
@@ -511,6 +4034,22 @@ def main():
 
     args = parser.parse_args()
 
+    partitioned_queues = None
+
+    if args.partitioned_queue:
+        try:
+            partitioned_queues = [(x, y, int(z)) for x, y, z in args.partitioned_queue]
+        except ValueError:
+            parser.error("Partition counts must be integers")
+
+    watermarks = None
+
+    if args.watermarks:
+        try:
+            watermarks = [(x, int(y), int(z)) for x, y, z in args.watermarks]
+        except ValueError:
+            parser.error("Watermarks must be integers")
+
     class _Broker(Broker):
         def debug(self, message, *args):
             if self.debug_enabled:
@@ -535,7 +4074,14 @@ def main():
     broker = _Broker(args.host, args.port, id=args.id, ready_file=args.ready_file,
                      # user=args.user, password=args.password, allowed_mechs=args.allowed_mechs,
                      cert=args.cert, key=args.key, trust=args.trust,
-                     topics=args.topic,
+                     topics=args.topic, retention=args.retention,
+                     priority_queues=args.priority_queue, last_value_queues=args.last_value_queue,
+                     partitioned_queues=partitioned_queues, watermarks=watermarks,
+                     passthrough=args.passthrough,
+                     dead_letters=args.dead_letter, max_deliveries=args.max_deliveries,
+                     journal_dir=args.journal, fsync=args.fsync, checkpoint_interval=args.checkpoint_interval,
+                     idle_timeout=args.idle_timeout,
+                     workers=args.workers, spill_after=args.spill_after, spill_dir=args.spill_dir,
                      quiet=args.quiet, verbose=args.verbose, debug_enabled=args.debug,
                      init_only=args.init_only)
 
@@ -268,6 +268,10 @@ class MessagingHandler(_handlers.MessagingHandler):
         self.connection = None
         self.done_sending = False
 
+        # Set by commands whose connection has links for one address
+        # only, so the server may redirect it to another host or port
+        self.redirectable = False
+
     def on_start(self, event):
         self.open(event)
 
@@ -300,11 +304,17 @@ class MessagingHandler(_handlers.MessagingHandler):
         else:
             self.command.info("Connecting to {}", connection_url)
 
+        offered_capabilities = None
+
+        if self.redirectable:
+            offered_capabilities = [_proton.symbol("qtools:redirect")]
+
         self.connection = event.container.connect(connection_url,
                                                   user=self.command.user,
                                                   password=self.command.password,
                                                   allowed_mechs=self.command.sasl_mechs,
-                                                  ssl_domain=ssl_domain)
+                                                  ssl_domain=ssl_domain,
+                                                  offered_capabilities=offered_capabilities)
 
     def close(self, event):
         self.connection.close()
@@ -313,7 +323,33 @@ class MessagingHandler(_handlers.MessagingHandler):
     def on_connection_opened(self, event):
         self.command.info("Connected to {}", event.connection)
 
+    def on_connection_error(self, event):
+        cond = event.connection.remote_condition
+
+        if cond.name != "amqp:connection:redirect" or not cond.info:
+            super().on_connection_error(event)
+            return
+
+        # Nothing is sent before the server redirects, so opening
+        # again at the new host and port starts over cleanly
+        self.command.host = cond.info.get("network-host", self.command.host)
+        self.command.port = str(int(cond.info.get("port", self.command.port)))
+
+        self.command.info("Redirected to {}:{}", self.command.host, self.command.port)
+
+        self.open(event)
+
     def on_link_opened(self, event):
+        # The server refuses a link with a null terminus, as it does
+        # before a redirect
+        if event.link.is_receiver:
+            terminus = event.link.remote_source
+        else:
+            terminus = event.link.remote_target
+
+        if terminus.type == _proton.Terminus.UNSPECIFIED:
+            return
+
         if event.link.is_receiver:
             self.command.notice("Created receiver for {} on {}", event.link.source, event.connection)
 
@@ -491,6 +527,13 @@ def convert_data_to_message(data):
         for name in props:
             message.properties[name] = props[name]
 
+    if "annotations" in data:
+        annotations = data["annotations"]
+        message.annotations = dict()
+
+        for name in annotations:
+            message.annotations[_proton.symbol(name)] = annotations[name]
+
     return message
 
 def _set_message_attribute(message, mname, data, dname):
@@ -519,12 +562,21 @@ def convert_message_to_data(message):
     if message.ttl != 0:
         _set_data_attribute(data, "ttl", message, "ttl")
 
+    if message.delivery_count != 0:
+        _set_data_attribute(data, "delivery_count", message, "delivery_count")
+
     if message.properties:
         props = data["properties"] = _collections.OrderedDict()
 
         for name in message.properties:
             props[name] = message.properties[name]
 
+    if message.annotations:
+        annotations = data["annotations"] = _collections.OrderedDict()
+
+        for name in message.annotations:
+            annotations[name] = message.annotations[name]
+
     _set_data_attribute(data, "subject", message, "subject")
     _set_data_attribute(data, "body", message, "body")
 
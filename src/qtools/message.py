@@ -67,6 +67,8 @@ class MessageCommand(Command):
                                    help="Set the priority to INTEGER")
         field_options.add_argument("--ttl", metavar="FLOAT",
                                    help="Set the time-to-live to FLOAT seconds")
+        field_options.add_argument("--delay", metavar="FLOAT",
+                                   help="Ask the server to hold the message for FLOAT seconds before delivering it")
         field_options.add_argument("--subject", metavar="STRING",
                                    help="Set the message summary")
         field_options.add_argument("--body", metavar="STRING",
@@ -126,6 +128,14 @@ class MessageCommand(Command):
 
             self.message.ttl = ttl
 
+        if args.delay is not None:
+            try:
+                delay = float(args.delay)
+            except ValueError:
+                self.fail("Delay value must be a float")
+
+            self.message.annotations = {_proton.symbol("x-opt-delivery-delay"): int(delay * 1000)}
+
         self.message.properties = _collections.OrderedDict()
 
         if args.property is not None:
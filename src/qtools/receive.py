@@ -58,6 +58,16 @@ class ReceiveCommand(MessagingCommand):
                                             help="Print delivery and message annotations")
         self.messaging_options.add_argument("--properties", action="store_true",
                                             help="Print message application properties")
+        self.messaging_options.add_argument("--selector", metavar="EXPR",
+                                            help="Receive only messages matching the selector EXPR")
+        self.messaging_options.add_argument("--presettled", action="store_true",
+                                            help="Receive messages fire-and-forget (at-most-once delivery)")
+        self.messaging_options.add_argument("--subscription", metavar="NAME",
+                                            help="Use the durable subscription NAME.  "
+                                            "Set --id as well, so the subscription is found again.")
+        self.messaging_options.add_argument("--start", metavar="POSITION",
+                                            help="Start a new topic subscription at POSITION.  "
+                                            "POSITION is 'earliest', 'now', or a time in seconds since the epoch.")
 
     def init(self, args):
         super().init(args)
@@ -67,6 +77,19 @@ class ReceiveCommand(MessagingCommand):
         self.json_enabled = args.json
         self.annotations_enabled = args.annotations
         self.properties_enabled = args.properties
+        self.presettled = args.presettled
+        self.selector = args.selector
+        self.subscription = args.subscription
+        self.start = None
+
+        if args.start in ("earliest", "now"):
+            self.start = _proton.symbol(args.start)
+        elif args.start is not None:
+            try:
+                self.start = _proton.timestamp(int(float(args.start) * 1000))
+            except ValueError:
+                self.fail("Invalid start position '{}'", args.start)
+
         self.desired_messages = args.count
 
         if args.output is not None:
@@ -85,13 +108,34 @@ class _Handler(MessagingHandler):
     def __init__(self, command):
         super().__init__(command)
 
+        self.redirectable = True
+
         self.receiver = None
         self.received_messages = 0
 
     def open(self, event):
         super().open(event)
 
-        self.receiver = event.container.create_receiver(self.connection, self.command.address)
+        filters = dict()
+        options = list()
+
+        if self.command.selector is not None:
+            filters.update(_reactor.Selector(self.command.selector).filter_set)
+
+        if self.command.start is not None:
+            filters[_proton.symbol("qtools:start")] = self.command.start
+
+        if filters:
+            options.append(_reactor.Filter(filters))
+
+        if self.command.presettled:
+            options.append(_reactor.AtMostOnce())
+
+        if self.command.subscription is not None:
+            options.append(_reactor.DurableSubscription())
+
+        self.receiver = event.container.create_receiver(self.connection, self.command.address,
+                                                        name=self.command.subscription, options=options)
 
     def close(self, event):
         super().close(event)
@@ -85,6 +85,8 @@ class _Handler(MessagingHandler):
     def __init__(self, command):
         super().__init__(command)
 
+        self.redirectable = True
+
         self.sender = None
         self.sent_messages = 0
         self.settled_messages = 0
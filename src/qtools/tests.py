@@ -20,6 +20,9 @@
 import sys
 
 from .plano import *
+from proton import Message
+from proton.handlers import MessagingHandler
+from proton.reactor import Container
 from subprocess import PIPE
 
 test_cert_dir = join(get_parent_dir(__file__), "testcerts")
@@ -77,6 +80,178 @@ def run_qrequest_and_qrespond(url, qmessage_args="", qrequest_args="", qrespond_
 
         return read(output)[:-1]
 
+class Settler(MessagingHandler):
+    # Takes one message per outcome, settles each with its outcome
+    # ("release", "reject", or None to leave it unsettled), and
+    # disconnects
+
+    def __init__(self, url, outcomes):
+        super().__init__(prefetch=0, auto_accept=False)
+
+        self.url = url
+        self.outcomes = outcomes
+        self.received = 0
+
+    def on_start(self, event):
+        receiver = event.container.create_receiver(self.url)
+        receiver.flow(len(self.outcomes))
+
+    def on_message(self, event):
+        outcome = self.outcomes[self.received]
+        self.received += 1
+
+        if outcome == "release":
+            self.release(event.delivery, delivered=False)
+        elif outcome == "reject":
+            self.reject(event.delivery)
+
+        if self.received == len(self.outcomes):
+            event.connection.close()
+
+class PartitionHandoff(MessagingHandler):
+    # Takes one message from each of two partitions on a first consumer
+    # and leaves them unsettled.  A second consumer then joins, taking
+    # over one partition, and one more message is sent to each.  After
+    # a while, the first consumer accepts its messages.
+
+    def __init__(self, url, address):
+        super().__init__(prefetch=0, auto_accept=False)
+
+        self.url = url
+        self.address = address
+
+        self.held = list()
+        self.received = list()
+        self.received_while_held = None
+        self.sent = False
+
+    def on_start(self, event):
+        self.container = event.container
+
+        connection = event.container.connect(self.url)
+        self.receiver1 = event.container.create_receiver(connection, self.address)
+        self.receiver1.flow(2)
+
+    def on_message(self, event):
+        if event.receiver == self.receiver1:
+            self.held.append(event.delivery)
+
+            if len(self.held) == 2:
+                connection = self.container.connect(self.url)
+                self.receiver2 = self.container.create_receiver(connection, self.address)
+                self.receiver2.flow(10)
+                self.container.create_sender(connection, self.address)
+        else:
+            self.accept(event.delivery)
+            self.received.append(event.message.body)
+
+            if self.received_while_held is not None:
+                event.connection.close()
+                self.receiver1.connection.close()
+
+    def on_sendable(self, event):
+        if not self.sent:
+            for key in ("a", "d"):
+                event.sender.send(Message(properties={"key": key}, body=f"{key}2"))
+
+            self.sent = True
+            self.container.schedule(1, self)
+
+    def on_timer_task(self, event):
+        self.received_while_held = list(self.received)
+
+        for delivery in self.held:
+            self.accept(delivery)
+
+        # Nothing more is coming if the partition did not wait
+        if self.received:
+            self.receiver1.connection.close()
+            self.receiver2.connection.close()
+
+class OneShotSender(MessagingHandler):
+    # Sends one message, over the anonymous relay if there is no
+    # target, and records whether it was accepted, rejected, or the
+    # link was refused
+
+    def __init__(self, url, message, target=None):
+        super().__init__()
+
+        self.url = url
+        self.message = message
+        self.target = target
+        self.sent = False
+        self.outcome = None
+
+    def on_start(self, event):
+        connection = event.container.connect(self.url)
+        event.container.create_sender(connection, self.target)
+
+    def on_link_error(self, event):
+        self.outcome = "refused"
+        event.connection.close()
+
+    def on_sendable(self, event):
+        if not self.sent:
+            event.sender.send(self.message)
+            self.sent = True
+
+    def on_accepted(self, event):
+        self.outcome = "accepted"
+        event.connection.close()
+
+    def on_rejected(self, event):
+        self.outcome = "rejected"
+        event.connection.close()
+
+class AbandonedReplyQueue(MessagingHandler):
+    # Sends a message with a TTL to a dynamic queue that never takes
+    # it, then closes the queue's link
+
+    def __init__(self, url):
+        super().__init__(prefetch=0)
+
+        self.url = url
+        self.sent = False
+
+    def on_start(self, event):
+        connection = event.container.connect(self.url)
+        event.container.create_receiver(connection, None, dynamic=True)
+
+    def on_link_opened(self, event):
+        if event.link.is_receiver:
+            event.container.create_sender(event.connection, event.link.remote_source.address)
+
+    def on_sendable(self, event):
+        if not self.sent:
+            event.sender.send(Message(body="abandoned", ttl=0.5))
+            self.sent = True
+
+    def on_accepted(self, event):
+        event.connection.close()
+
+class RedirectProbe(MessagingHandler):
+    # Attaches a sender to address, offering to follow redirects, and
+    # records where the server sends the connection
+
+    def __init__(self, url, address):
+        super().__init__()
+
+        self.url = url
+        self.address = address
+        self.port = None
+
+    def on_start(self, event):
+        connection = event.container.connect(self.url, offered_capabilities=["qtools:redirect"])
+        event.container.create_sender(connection, self.address)
+
+    def on_connection_error(self, event):
+        condition = event.connection.remote_condition
+
+        if condition.name == "amqp:connection:redirect":
+            self.port = int(condition.info["port"])
+
+        event.connection.close()
+
 class TestServer:
     def __init__(self, **extra_args):
         port = get_random_port()
@@ -146,6 +321,487 @@ def qsend_and_qreceive():
         run_qsend_and_qreceive(server.url, "--count 10", "", "--count 10")
         run_qsend_and_qreceive(server.url, "--count 10 --rate 1000", "", "--count 10")
 
+@test(timeout=5)
+def competing_consumers():
+    with TestServer() as server, temp_file() as ready1, temp_file() as ready2:
+        receive_procs = [start_qreceive(server.url, f"--count 5 --ready-file {x}") for x in (ready1, ready2)]
+
+        try:
+            for ready_file in (ready1, ready2):
+                while read(ready_file) != "ready\n":
+                    sleep(0.1)
+
+            run(f"qsend {server.url} 1 2 3 4 5 6 7 8 9 10")
+
+            for proc in receive_procs:
+                wait(proc)
+        except:
+            for proc in receive_procs:
+                kill(proc)
+
+            raise
+
+@test(timeout=10)
+def watermarks():
+    with TestServer(watermarks="queue1 5 2") as server:
+        with temp_file() as ready:
+            send_proc = start_qsend(server.url, f"1 2 3 4 5 6 7 8 9 10 --ready-file {ready}")
+
+            try:
+                while read(ready) != "ready\n":
+                    sleep(0.1)
+
+                sleep(0.5)
+
+                # The sender is blocked until the queue drains
+                assert send_proc.poll() is None
+
+                result = call(f"qreceive {server.url} --count 10")
+                assert result.split() == [str(x) for x in range(1, 11)], result
+
+                wait(send_proc)
+            except:
+                kill(send_proc)
+                raise
+
+@test(timeout=10)
+def spill():
+    with TestServer(**{"spill-after": 10}) as server:
+        run(f"qmessage --count 100 | qsend {server.url}", shell=True)
+
+        result = call(f"qreceive {server.url} --count 100")
+        assert result.split() == ["message-{:04}".format(x) for x in range(1, 101)], result
+
+@test(timeout=10)
+def expiry():
+    for extra_args in ({"spill-after": 10}, {"topic": "queue1"}):
+        with TestServer(**extra_args) as server:
+            run(f"qmessage --count 20 --ttl 0.5 | qsend {server.url}", shell=True)
+            sleep(1)
+            run(f"qsend {server.url} live")
+
+            result = call(f"qreceive {server.url} --count 1")
+            assert result.strip() == "live", result
+
+@test(timeout=5)
+def priority_queue():
+    with TestServer(**{"priority-queue": "queue1"}) as server:
+        run(f"qmessage --count 3 --priority 1 --body low | qsend {server.url}", shell=True)
+        run(f"qmessage --count 3 --priority 9 --body high | qsend {server.url}", shell=True)
+
+        result = call(f"qreceive {server.url} --count 6")
+        assert result.split() == ["high"] * 3 + ["low"] * 3, result
+
+@test(timeout=5)
+def last_value_queue():
+    with TestServer(**{"last-value-queue": "queue1 symbol"}) as server:
+        run(f"qmessage --property symbol abc --body abc-1 | qsend {server.url}", shell=True)
+        run(f"qmessage --property symbol xyz --body xyz-1 | qsend {server.url}", shell=True)
+        run(f"qmessage --property symbol abc --body abc-2 | qsend {server.url}", shell=True)
+        run(f"qmessage --body none | qsend {server.url}", shell=True)
+
+        # The newer message takes the place of the older one
+        result = call(f"qreceive {server.url} --count 3")
+        assert result.split() == ["abc-2", "xyz-1", "none"], result
+
+@test(timeout=20)
+def delayed_delivery():
+    for extra_args in ({}, {"passthrough": ""}):
+        with TestServer(**extra_args) as server:
+            start_time = get_time()
+
+            run(f"qmessage --delay 1 --body later | qsend {server.url}", shell=True)
+            run(f"qsend {server.url} now")
+
+            result = call(f"qreceive {server.url} --count 2")
+            assert result.split() == ["now", "later"], result
+            assert get_time() - start_time >= 1, get_time() - start_time
+
+    # Wildcard subscribers get scheduled messages when they are due
+    with TestServer() as server, temp_file() as ready, temp_file() as output:
+        url = server.url.rsplit("/", 1)[0]
+        receive_proc = start_qreceive(f"{url}/orders.*", f"--count 2 --ready-file {ready}", stdout=output)
+
+        try:
+            while read(ready) != "ready\n":
+                sleep(0.1)
+
+            start_time = get_time()
+
+            run(f"qmessage --delay 1 --body later | qsend {url}/orders.eu", shell=True)
+            run(f"qsend {url}/orders.eu now")
+
+            wait(receive_proc)
+        except:
+            kill(receive_proc)
+            raise
+
+        result = read(output)
+        assert result.split() == ["now", "later"], result
+        assert get_time() - start_time >= 1, get_time() - start_time
+
+    # After a restart, scheduled messages keep their original due
+    # time, and those already due are not held again
+    with temp_dir() as dir:
+        with TestServer(journal=dir) as server:
+            run(f"qmessage --durable --delay 1 --body due | qsend {server.url}", shell=True)
+            run(f"qmessage --durable --delay 3 --body held | qsend {server.url}", shell=True)
+            sleep(1.5)
+
+        with TestServer(journal=dir) as server:
+            start_time = get_time()
+
+            result = call(f"qreceive {server.url} --count 1")
+            assert result.split() == ["due"], result
+            assert get_time() - start_time < 1, get_time() - start_time
+
+            result = call(f"qreceive {server.url} --count 1")
+            assert result.split() == ["held"], result
+            assert get_time() - start_time < 2.5, get_time() - start_time
+
+@test(timeout=15)
+def partitioned_queue():
+    with TestServer(**{"partitioned-queue": "queue1 key 4"}) as server, temp_file() as ready1, \
+         temp_file() as ready2, temp_file() as output1, temp_file() as output2:
+        receive_proc1 = start_qreceive(server.url, f"--count 3 --ready-file {ready1}", stdout=output1)
+        receive_proc2 = start_qreceive(server.url, f"--count 3 --ready-file {ready2}", stdout=output2)
+
+        try:
+            while read(ready1) != "ready\n" or read(ready2) != "ready\n":
+                sleep(0.1)
+
+            for i in range(1, 4):
+                for key in ("a", "b"):
+                    run(f"qmessage --property key {key} --body {key}{i} | qsend {server.url}", shell=True)
+
+            wait(receive_proc1)
+            wait(receive_proc2)
+        except:
+            kill(receive_proc1)
+            kill(receive_proc2)
+            raise
+
+        # Each key goes to one consumer, in order
+        results = sorted([read(output1).split(), read(output2).split()])
+        assert results == [["a1", "a2", "a3"], ["b1", "b2", "b3"]], results
+
+    # A partition that moves to a new consumer waits until the old one
+    # settles what it has from it
+    with TestServer(**{"partitioned-queue": "queue1 key 2"}) as server:
+        for key in ("a", "d"):
+            run(f"qmessage --property key {key} --body {key}1 | qsend {server.url}", shell=True)
+
+        url, address = server.url.rsplit("/", 1)
+        handler = PartitionHandoff(url, address)
+        Container(handler).run()
+
+        assert handler.received_while_held == [], handler.received_while_held
+        assert handler.received == ["a2"], handler.received
+
+@test(timeout=20)
+def selector():
+    for extra_args in ({}, {"passthrough": ""}, {"topic": "queue1"}):
+        with TestServer(**extra_args) as server:
+            run(f"qmessage --count 3 --property color red --body red | qsend {server.url}", shell=True)
+            run(f"qmessage --count 3 --property color blue --body blue | qsend {server.url}", shell=True)
+
+            result = call(f"qreceive {server.url} --count 3 --selector \"color = 'blue'\"")
+            assert result.split() == ["blue"] * 3, result
+
+            # Topic consumers see every message
+            if "topic" not in extra_args:
+                result = call(f"qreceive {server.url} --count 3")
+                assert result.split() == ["red"] * 3, result
+
+    # Messages taken by a selector stay out of checkpoints
+    with temp_dir() as dir:
+        with TestServer(journal=dir, **{"checkpoint-interval": 0.1}) as server:
+            run(f"qmessage --count 3 --durable --property color red --body red | qsend {server.url}", shell=True)
+            run(f"qmessage --count 3 --durable --property color blue --body blue | qsend {server.url}", shell=True)
+
+            result = call(f"qreceive {server.url} --count 3 --selector \"color = 'blue'\"")
+            assert result.split() == ["blue"] * 3, result
+
+            sleep(0.5)
+
+        with TestServer(journal=dir) as server:
+            run(f"qsend {server.url} end")
+
+            result = call(f"qreceive {server.url} --count 4")
+            assert result.split() == ["red"] * 3 + ["end"], result
+
+@test(timeout=5)
+def topic():
+    with TestServer(topic="queue1") as server:
+        run_qsend_and_qreceive(server.url, "--count 10", "", "--count 10")
+
+        result = run_qsend_and_qreceive(server.url, "--body abc123", "", "--count 11")
+        assert result.endswith("abc123"), result
+
+@test(timeout=10)
+def wildcard_subscription():
+    with TestServer() as server, temp_file() as ready, temp_file() as output:
+        url = server.url.rsplit("/", 1)[0]
+        receive_proc = start_qreceive(f"{url}/orders.*.created", f"--count 2 --ready-file {ready}", stdout=output)
+
+        try:
+            while read(ready) != "ready\n":
+                sleep(0.1)
+
+            # A message with no address has nowhere to go
+            sender = OneShotSender(url, Message(body="lost"))
+            Container(sender).run()
+            assert sender.outcome == "rejected", sender.outcome
+
+            # Nor does one sent to the subscription's own pattern
+            sender = OneShotSender(url, Message(body="pattern"), "orders.*.created")
+            Container(sender).run()
+            assert sender.outcome == "refused", sender.outcome
+
+            sender = OneShotSender(url, Message(address="orders.*.created", body="pattern"))
+            Container(sender).run()
+            assert sender.outcome == "rejected", sender.outcome
+
+            run(f"qsend {url}/orders.eu.created eu")
+            run(f"qsend {url}/orders.eu.deleted deleted")
+            run(f"qsend {url}/orders.us.created us")
+
+            wait(receive_proc)
+        except:
+            kill(receive_proc)
+            raise
+
+        result = read(output)
+        assert result.split() == ["eu", "us"], result
+
+@test(timeout=10)
+def consumer_group():
+    with TestServer(topic="queue1") as server, temp_file() as ready1, temp_file() as ready2, \
+         temp_file() as output1, temp_file() as output2:
+        # The group members share the messages
+        member1 = start_qreceive(f"{server.url}::group1", f"--count 2 --ready-file {ready1}", stdout=output1)
+        member2 = start_qreceive(f"{server.url}::group1", f"--count 2 --ready-file {ready2}", stdout=output2)
+
+        try:
+            while read(ready1) != "ready\n" or read(ready2) != "ready\n":
+                sleep(0.1)
+
+            run(f"qsend {server.url} 1 2 3 4")
+
+            wait(member1)
+            wait(member2)
+        except:
+            kill(member1)
+            kill(member2)
+            raise
+
+        result = read(output1).split() + read(output2).split()
+        assert sorted(result) == ["1", "2", "3", "4"], result
+
+        # A receiver outside the group still gets every message
+        result = call(f"qreceive {server.url} --count 4")
+        assert result.split() == ["1", "2", "3", "4"], result
+
+@test(timeout=10)
+def durable_subscription():
+    with TestServer(topic="queue1") as server, temp_file() as ready, temp_file() as output:
+        subscription = "--id durable-client --subscription sub1"
+
+        run(f"qsend {server.url} 1 2")
+        sleep(0.1)
+        start_time = get_time()
+        sleep(0.1)
+        run(f"qsend {server.url} 3 4")
+
+        result = call(f"qreceive {server.url} {subscription} --count 4")
+        assert result.split() == ["1", "2", "3", "4"], result
+
+        # The subscription resumes after the last delivered message
+        run(f"qsend {server.url} 5")
+
+        result = call(f"qreceive {server.url} {subscription} --count 1")
+        assert result.split() == ["5"], result
+
+        # Start positions use the time each message was stored
+        result = call(f"qreceive {server.url} --start {start_time} --count 2")
+        assert result.split()[:2] == ["3", "4"], result
+
+        receive_proc = start_qreceive(server.url, f"--start now --count 1 --ready-file {ready}", stdout=output)
+
+        try:
+            while read(ready) != "ready\n":
+                sleep(0.1)
+
+            run(f"qsend {server.url} 6")
+
+            wait(receive_proc)
+        except:
+            kill(receive_proc)
+            raise
+
+        result = read(output)
+        assert result.split() == ["6"], result
+
+    # Saved offsets and message offsets survive a restart
+    with temp_dir() as dir:
+        subscription = "--id durable-client --subscription sub1"
+
+        with TestServer(topic="queue1", journal=dir, **{"checkpoint-interval": 0.1}) as server:
+            run(f"qmessage --count 4 --durable | qsend {server.url}", shell=True)
+
+            result = call(f"qreceive {server.url} {subscription} --count 4")
+            assert len(result.split()) == 4, result
+
+            sleep(0.5)
+            start_time = get_time()
+            sleep(0.1)
+
+        with TestServer(topic="queue1", journal=dir) as server:
+            run(f"qmessage --durable --body last | qsend {server.url}", shell=True)
+
+            result = call(f"qreceive {server.url} {subscription} --count 1")
+            assert result.split() == ["last"], result
+
+        with TestServer(topic="queue1", journal=dir) as server:
+            result = call(f"qreceive {server.url} {subscription} --count 1")
+            assert result.split() == ["last"], result
+
+            result = call(f"qreceive {server.url} --count 5")
+            assert result.split()[4] == "last", result
+
+            # Recovered messages keep the time they were first stored
+            result = call(f"qreceive {server.url} --start {start_time} --count 1")
+            assert result.split() == ["last"], result
+
+@test(timeout=10)
+def redelivery():
+    with TestServer() as server:
+        run(f"qsend {server.url} 1 2 3 4")
+
+        Container(Settler(server.url, ["release", None, None])).run()
+
+        # Released messages are not counted as failed deliveries.  Of
+        # those left unsettled, only the oldest is.
+        result = call(f"qreceive {server.url} --count 4 --json")
+        result = [parse_json(x) for x in result.splitlines()[:4]]
+
+        assert [x["body"] for x in result] == ["2", "3", "1", "4"], result
+        assert [x.get("delivery_count", 0) for x in result] == [1, 0, 0, 0], result
+
+@test(timeout=10)
+def dead_letter():
+    with TestServer(**{"dead-letter": "queue1 dead1", "max-deliveries": 2}) as server:
+        url = server.url.rsplit("/", 1)[0]
+
+        run(f"qsend {server.url} 1 2 3")
+
+        # The first is rejected, and the second fails twice
+        Container(Settler(server.url, ["reject"])).run()
+        Container(Settler(server.url, [None])).run()
+        Container(Settler(server.url, [None])).run()
+
+        result = call(f"qreceive {url}/dead1 --count 2")
+        assert result.split()[:2] == ["1", "2"], result
+
+        result = call(f"qreceive {server.url} --count 1")
+        assert result.split() == ["3"], result
+
+        result = call(f"qreceive {url}/$metrics --count 1 --json")
+        metrics = parse_json(result.splitlines()[0])["body"]
+
+        assert metrics["rejected_messages"] == 1, metrics
+        assert metrics["dead_lettered_messages"] == 2, metrics
+
+    # A consumer that detaches fails only its oldest unsettled
+    # delivery.  The rest were only prefetched.
+    with TestServer(**{"dead-letter": "queue1 dead1", "max-deliveries": 1}) as server:
+        url = server.url.rsplit("/", 1)[0]
+
+        run(f"qsend {server.url} 1 2 3")
+
+        Container(Settler(server.url, [None, None, None])).run()
+
+        result = call(f"qreceive {url}/dead1 --count 1")
+        assert result.split() == ["1"], result
+
+        result = call(f"qreceive {server.url} --count 2")
+        assert result.split() == ["2", "3"], result
+
+@test(timeout=10)
+def node_cleanup():
+    with TestServer(**{"idle-timeout": 0.5}) as server:
+        url = server.url.rsplit("/", 1)[0]
+
+        # The reply queue is deleted with its link, and the request
+        # queue once it is idle
+        run_qrequest_and_qrespond(server.url, "--count 3", "", "--count 3")
+        sleep(1.5)
+
+        result = call(f"qreceive {url}/$metrics --count 1 --json")
+        assert parse_json(result.splitlines()[0])["body"]["nodes"] == 0, result
+
+        # Messages deleted with their queue do not expire later
+        Container(AbandonedReplyQueue(url)).run()
+        sleep(1)
+
+        result = call(f"qreceive {url}/$metrics --count 1 --json")
+        assert parse_json(result.splitlines()[0])["body"].get("expired_messages", 0) == 0, result
+
+@test(timeout=15)
+def topic_retention():
+    with TestServer(topic="queue1", retention="queue1 count:5") as server:
+        run(f"qsend {server.url} 1 2 3 4 5 6 7 8 9 10")
+
+        result = call(f"qreceive {server.url} --count 5")
+        assert result.split() == ["6", "7", "8", "9", "10"], result
+
+    # The oldest messages go to keep the topic under the byte limit
+    with TestServer(topic="queue1", retention="queue1 bytes:1000") as server:
+        bodies = ["{0:0100}".format(x) for x in range(1, 11)]
+        run(f"qsend {server.url} {' '.join(bodies)}")
+
+        result = call(f"qreceive {server.url} --count 1")
+        assert 1 < int(result.split()[0]) < 10, result
+
+    with TestServer(topic="queue1", retention="queue1 age:0.5") as server:
+        run(f"qsend {server.url} 1 2 3")
+        sleep(1)
+        run(f"qsend {server.url} 4")
+
+        result = call(f"qreceive {server.url} --count 1")
+        assert result.split() == ["4"], result
+
+    # The slowest policy keeps what a detached durable subscriber has
+    # yet to receive
+    with TestServer(topic="queue1", retention="queue1 slowest") as server, temp_file() as ready, \
+         temp_file() as output:
+        subscription = "--id durable-client --subscription sub1"
+        receive_proc = start_qreceive(server.url, f"{subscription} --count 2 --ready-file {ready}", stdout=output)
+
+        try:
+            while read(ready) != "ready\n":
+                sleep(0.1)
+
+            run(f"qsend {server.url} 1 2")
+
+            wait(receive_proc)
+        except:
+            kill(receive_proc)
+            raise
+
+        run(f"qsend {server.url} 3 4")
+        sleep(1.5)
+
+        result = call(f"qreceive {server.url} {subscription} --count 2")
+        assert result.split() == ["3", "4"], result
+
+        # Once every subscriber has them, they are trimmed
+        sleep(1.5)
+        run(f"qsend {server.url} 5")
+
+        result = call(f"qreceive {server.url} --count 1")
+        assert result.split() == ["5"], result
+
 @test(timeout=5)
 def qrequest_and_qrespond():
     with TestServer() as server:
@@ -156,6 +812,159 @@ def qrequest_and_qrespond():
         run_qrequest_and_qrespond(server.url, "--count 10", "", "--count 10")
         run_qrequest_and_qrespond(server.url, "--count 10 --rate 1000", "", "--count 10")
 
+@test(timeout=5)
+def passthrough():
+    with TestServer(passthrough="") as server:
+        result = run_qsend_and_qreceive(server.url, "--body abc123 --property x y", "", "--count 1")
+        assert result == "abc123", result
+
+        result = run_qrequest_and_qrespond(server.url, "--body abc123", "", "--count 1 --upper")
+        assert result == "ABC123", result
+
+    with TestServer(passthrough="", topic="queue1") as server:
+        run_qsend_and_qreceive(server.url, "--count 10", "", "--count 10")
+
+@test(timeout=15)
+def journal():
+    with temp_dir() as dir:
+        with TestServer(journal=dir) as server:
+            run(f"qsend {server.url} abc")
+            run(f"qmessage --durable --body xyz | qsend {server.url}", shell=True)
+
+        with TestServer(journal=dir, fsync="always") as server:
+            result = call(f"qreceive {server.url} --count 1")
+            assert result == "xyz\n", result
+
+            run(f"qmessage --durable --body xyz | qsend {server.url}", shell=True)
+
+        with TestServer(journal=dir, fsync="10", **{"checkpoint-interval": 0.1}) as server:
+            result = call(f"qreceive {server.url} --count 1")
+            assert result == "xyz\n", result
+
+            run(f"qmessage --durable --body abc | qsend {server.url}", shell=True)
+            sleep(0.5)
+
+        assert len(list_dir(dir, "*.snapshot")) == 1, list_dir(dir)
+
+        with TestServer(journal=dir) as server:
+            result = call(f"qreceive {server.url} --count 1")
+            assert result == "abc\n", result
+
+    # A reply queue checkpointed while its link was open is evicted
+    # after a restart
+    with temp_dir() as dir:
+        with TestServer(journal=dir, **{"checkpoint-interval": 0.1}) as server:
+            message_proc = start_qmessage("--durable --count 1", stdout=PIPE)
+            request_proc = start_qrequest(server.url, "", stdin=message_proc.stdout)
+
+            try:
+                sleep(1)
+            finally:
+                kill(message_proc)
+                kill(request_proc)
+
+        with TestServer(journal=dir, **{"idle-timeout": 0.5}) as server:
+            url = server.url.rsplit("/", 1)[0]
+            sleep(1.5)
+
+            # Only the request queue is left
+            result = call(f"qreceive {url}/$metrics --count 1 --json")
+            assert parse_json(result.splitlines()[0])["body"]["nodes"] == 1, result
+
+@test(timeout=5)
+def journal_compaction():
+    from .brokerlib import Broker, _Journal, _Message
+
+    class Node:
+        address = "queue1"
+
+        def __init__(self, messages):
+            self.messages = messages
+
+        def checkpoint(self):
+            return {"address": self.address, "type": "queue"}
+
+    broker = Broker("localhost", 0, quiet=True)
+
+    with temp_dir() as dir:
+        journal = _Journal(broker, dir, fsync="never", segment_size=120)
+        journal.recover()
+
+        message = _Message(message=Message(body="m0", durable=True))
+        message.journal_id = journal.enqueue("queue1", message)
+
+        # The acknowledgment for a message in the snapshot lands in the
+        # segment after it, so compaction must keep that segment
+        journal.checkpoint([Node([message])])
+        journal.acknowledge(message.journal_id)
+        journal._rotate()
+        journal.compact()
+
+        journal = _Journal(broker, dir, fsync="never", segment_size=120)
+        states, records = journal.recover()
+
+        assert records == [], records
+
+@test(timeout=20)
+def workers():
+    with TestServer(workers=2) as server:
+        url = server.url.rsplit("/", 1)[0]
+
+        # Clients that can follow a redirect talk to the owning worker
+        # directly, and others are relayed
+        probe = RedirectProbe(url, "queue1")
+        Container(probe).run()
+        assert probe.port is not None and f":{probe.port}/" not in server.url, probe.port
+
+        sender = OneShotSender(url, Message(body="relayed"), "queue1")
+        Container(sender).run()
+        assert sender.outcome == "accepted", sender.outcome
+
+        result = call(f"qreceive {server.url} --count 1")
+        assert result.split() == ["relayed"], result
+
+        result = run_qsend_and_qreceive(server.url, "--body abc123", "", "--count 1")
+        assert result == "abc123", result
+
+        result = run_qrequest_and_qrespond(server.url, "--body abc123", "", "--count 1 --upper")
+        assert result == "ABC123", result
+
+        run_qsend_and_qreceive(server.url, "--count 10", "--presettled", "--count 10")
+
+    # Addresses are spread over the workers by their full name, and a
+    # wildcard subscription gets messages from all of them
+    with TestServer(workers=2) as server, temp_file() as ready, temp_file() as output:
+        url = server.url.rsplit("/", 1)[0]
+        receive_proc = start_qreceive(f"{url}/*.*.created", f"--count 2 --ready-file {ready}", stdout=output)
+
+        try:
+            while read(ready) != "ready\n":
+                sleep(0.1)
+
+            run(f"qsend {url}/orders.eu.created eu")
+            run(f"qsend {url}/orders.ap.created ap")
+
+            wait(receive_proc)
+        except:
+            kill(receive_proc)
+            raise
+
+        result = read(output)
+        assert sorted(result.split()) == ["ap", "eu"], result
+
+    # Queues that share a dead-letter address are on the same worker
+    with TestServer(workers=2, **{"dead-letter": "qa dlq --dead-letter qd dlq"}) as server:
+        url = server.url.rsplit("/", 1)[0]
+
+        run(f"qsend {url}/qa from-qa")
+        run(f"qsend {url}/qd from-qd")
+
+        Container(Settler(f"{url}/qa", ["reject"])).run()
+        Container(Settler(f"{url}/qd", ["reject"])).run()
+
+        result = call(f"qreceive {url}/dlq --count 2")
+        assert sorted(result.split()) == ["from-qa", "from-qd"], result
+
 @test(timeout=5)
 def qmessage():
     with TestServer() as server: